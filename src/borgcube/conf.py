@@ -183,6 +183,78 @@ BUILTIN_ZEO = True
 DB_URI = 'file:///var/...somewhere...'
 
 
+# Before a backup job is started borgcubed checks that the client is reachable and has a working Borg.
+# This is the time (in seconds) after which a client is considered unreachable; None disables the check.
+CLIENT_PROBE_TIMEOUT = 10
+
+# Occurences of schedules missed by borgcubed (because it was busy, restarting or not running at all)
+# are executed once it notices, if they are no older than this (seconds). Several missed occurences of
+# a schedule are only executed once. Older occurences are skipped.
+SCHEDULE_CATCH_UP = 12 * 3600
+
+# borgcubed can push the chunks cache to clients ahead of their scheduled backups, so that
+# the backup itself only needs to transfer a small delta. This is how far ahead of a scheduled
+# backup this is done (a datetime.timedelta); None disables it.
+CACHE_STAGING_AHEAD = None
+
+# Bandwidth limit for these transfers in KiB/s (cf. rsync --bwlimit), None for no limit.
+CACHE_STAGING_BWLIMIT = None
+
+
+# Queued jobs are dispatched by priority. To make sure that low-priority jobs eventually run,
+# queued jobs gain one priority level per this many seconds of waiting; None disables this.
+JOB_PRIORITY_AGING = 600
+
+# borgcubed keeps this many idle worker processes around, which already connected to the database,
+# so that jobs start without the delay of forking a new worker and opening the database.
+# 0 forks a new worker for every job.
+WORKER_POOL_SIZE = 2
+
+# Resource classes of the workers running jobs, per type of job (eg. 'backup', 'check', 'prune'):
+#   nice: CPU niceness increment (cf. nice(1))
+#   ionice: I/O scheduling class and level (cf. ionice(1)), eg. ('best-effort', 7) or ('idle', None)
+#   cgroup: cgroup v2 directory the worker is moved into (created if needed), eg. '/sys/fs/cgroup/borgcube/check'
+#   cpu_weight, io_weight: written to cpu.weight and io.weight of that cgroup
+# For example, to keep data verification from starving backups:
+# JOB_RESOURCE_CLASSES = {
+#     'check': {'nice': 10, 'ionice': ('idle', None)},
+# }
+JOB_RESOURCE_CLASSES = {}
+
+# Running jobs signal progress (heartbeats) with every state change and, for backups, with the repository
+# operations of the client. Jobs without heartbeat for longer than their stall timeout (in seconds, per
+# type of job) are cancelled with the 'stalled' failure cause, so that they don't hold up other jobs.
+# Mind that some phases may be silent for a long time (eg. transferring a large cache to a client).
+# For example: STALL_TIMEOUTS = {'backup': 2 * 3600}
+STALL_TIMEOUTS = {}
+
+# Limits on the number of jobs borgcubed runs at the same time; None means no limit.
+# Jobs exceeding a limit wait in the queue.
+MAX_JOBS = None
+MAX_JOBS_PER_REPOSITORY = None
+MAX_JOBS_PER_CLIENT = None
+# Maxima per type of job (the short name, eg. 'backup', 'check' or 'prune'), eg. {'check': 2}.
+MAX_JOBS_PER_TYPE = {}
+
+# Address (host:port) on which borgcubed serves metrics (http://host:port/metrics) in the Prometheus
+# text format; None to disable. The built-in web server always serves them at /metrics/.
+METRICS_LISTEN = None
+
+# Jobs can also be run by worker agents (borgcubed --worker) on other hosts, which need access to the
+# database (DB_URI, eg. a ZEO server on TCP), to the repositories and to SERVER_LOGS_DIR.
+# On the main borgcubed: the zmq endpoints agents connect to, for the API (which only serves agents)
+# and for log records.
+# Only use these on trusted networks, there is no authentication.
+# AGENT_LISTEN = {'api': 'tcp://0.0.0.0:8003', 'log': 'tcp://0.0.0.0:8004'}
+AGENT_LISTEN = None
+# On worker agents: the endpoints of the main borgcubed,
+# eg. {'api': 'tcp://backup-server:8003', 'log': 'tcp://backup-server:8004'}
+AGENT_CONNECT = None
+# On worker agents: number of jobs to run at the same time, and the names of the repositories
+# the agent can reach (None for all of them).
+AGENT_CAPACITY = 4
+AGENT_REPOSITORIES = None
+
 # borgcubed can also run the web server itself, so you don't need to care about that,
 # if you like.
 # BUILTIN_WEB = '127.0.0.1:8002'
@@ -23,8 +23,9 @@ def borgcube_job_blocked(job, blocking_jobs):
     """
     Called to sort out whether *job* is blocked by any *blocking_jobs*.
 
-    *blocking_jobs* is a list of jobs that are aimed at the same repository as *job* and whose state
-    is not in Job.State.STABLE.
+    *blocking_jobs* is a list of active jobs that are aimed at the same repository as *job* and
+    conflict with it (see `JobExecutor.conflicts`). This is called for every conflict check, even if
+    *blocking_jobs* is empty, so jobs can add themselves.
 
     Remove any false positives from *blocking_jobs* that might be there because of special snowflake semantics
     with your jobs.
@@ -60,6 +61,8 @@ def borgcube_job_post_force_state(job, forced_state):
 def borgcube_job_failure_cause(job, kind, kwargs):
     """
     Called after the failure cause (defined by *kind* (str) and it's *kwargs*) is set for *job*.
+
+    The failure cause is already committed. If you modify the database, commit yourself.
     """
 
 
@@ -2,6 +2,7 @@ import datetime
 import inspect
 import logging
 import re
+import shlex
 from pathlib import Path
 
 import uuid
@@ -16,6 +17,7 @@ from django import forms
 import persistent
 import transaction
 from BTrees.LOBTree import LOBTree as TimestampTree
+from BTrees.LLBTree import LLTreeSet
 from BTrees.LOBTree import LOBTree
 from BTrees.OOBTree import OOBTree
 from persistent.list import PersistentList
@@ -28,6 +30,7 @@ from borg.helpers import Location
 
 import borgcube
 from borgcube.utils import data_root, hook
+from .occurences import RecurrenceEvaluator
 
 log = logging.getLogger(__name__)
 
@@ -292,9 +295,11 @@ class DataRoot(Evolvable):
     :ivar jobs: an `OOBTree` mapping TODO to `Job` instances.
     :ivar jobs_by_state: an `OOBTree` mapping job states to trees of `Job` instances.
     :ivar schedules: a `PersistentList` of `Schedule` instances.
+    :ivar active_jobs_by_config: an `OOBTree` mapping the oids of job configurations to a `LLTreeSet`
+                                 of the IDs of the queued or running jobs created from them (see `active_jobs_of`).
     :ivar ext: a `PersistentDict` of extension data (see `plugin_data`, **do not use directly**).
     """
-    version = 6
+    version = 7
 
     @evolve(1, 2)
     def add_ext_dict(self):
@@ -320,6 +325,17 @@ class DataRoot(Evolvable):
     def add_triggers(self):
         self.trigger_ids = OOBTree()
 
+    @evolve(6, 7)
+    def add_active_jobs_by_config(self):
+        self.active_jobs_by_config = OOBTree()
+        for state, jobs in self.jobs_by_state.items():
+            if state in Job.State.STABLE - {Job.State.job_created}:
+                continue
+            for id, job in jobs.items():
+                config = getattr(job, 'config', None)
+                if config is not None and config._p_oid:
+                    self.active_jobs_by_config.setdefault(config._p_oid, LLTreeSet()).add(id)
+
     def __init__(self):
         self.repositories = PersistentList()
         # hex archive id -> Archive
@@ -337,6 +353,9 @@ class DataRoot(Evolvable):
 
         self.trigger_ids = OOBTree()
 
+        # config oid -> set of job numbers (see Job._update_config_index)
+        self.active_jobs_by_config = OOBTree()
+
         self.ext = PersistentDict()
 
     def plugin_data(self, factory):
@@ -380,12 +399,16 @@ class DataRoot(Evolvable):
 
 
 class Repository(Evolvable):
-    version = 2
+    version = 3
 
     @evolve(1, 2)
     def add_job_configs(self):
         self.job_configs = PersistentList()
 
+    @evolve(2, 3)
+    def add_resource_usage(self):
+        self.resource_usage = PersistentDict()
+
     def __init__(self, name, url, description='', repository_id='', remote_borg='borg'):
         self.name = name
         self.url = url
@@ -395,6 +418,8 @@ class Repository(Evolvable):
         self.jobs = LOBTree()
         self.archives = OOBTree()
         self.job_configs = PersistentList()
+        # job type -> total resource usage of the jobs on this repository (see Job.account_resource_usage)
+        self.resource_usage = PersistentDict()
 
     @property
     def location(self):
@@ -522,6 +547,26 @@ class RshClientConnection(Evolvable):
         self.remote_borg = remote_borg
         self.remote_cache_dir = remote_cache_dir
 
+    def rsh_command(self, control_path=None):
+        """
+        Return the RSH command line (a list) including all options, but not the remote.
+
+        If *control_path* is given and the RSH is OpenSSH, connections are multiplexed over the
+        master connection listening there.
+        """
+        command_line = [self.rsh]
+        if self.ssh_identity_file:
+            command_line += '-i', self.ssh_identity_file
+        if self.rsh_options:
+            command_line += shlex.split(self.rsh_options)
+        if control_path and self.is_openssh:
+            command_line += '-o', 'ControlPath=' + control_path
+        return command_line
+
+    @property
+    def is_openssh(self):
+        return Path(self.rsh).name == 'ssh'
+
     class Form(forms.Form):
         prefix = 'connection'
 
@@ -534,12 +579,20 @@ class RshClientConnection(Evolvable):
 
 
 class Client(Evolvable):
-    version = 2
+    version = 4
 
     @evolve(1, 2)
     def add_job_configs(self):
         self.job_configs = PersistentList()
 
+    @evolve(2, 3)
+    def add_staged_caches(self):
+        self.staged_caches = PersistentDict()
+
+    @evolve(3, 4)
+    def add_resource_usage(self):
+        self.resource_usage = PersistentDict()
+
     def __init__(self, hostname, description='', connection=None):
         self.hostname = hostname
         self.description = description
@@ -547,6 +600,10 @@ class Client(Evolvable):
         self.jobs = LOBTree()
         self.archives = OOBTree()
         self.job_configs = PersistentList()
+        # repository ID -> version (manifest ID) of the chunks cache last transferred to the client
+        self.staged_caches = PersistentDict()
+        # job type -> total resource usage of the jobs of this client (see Job.account_resource_usage)
+        self.resource_usage = PersistentDict()
         data_root().clients[hostname] = self
 
     def latest_job(self):
@@ -570,23 +627,80 @@ class s(str):
         return str(self), self.verbose_name
 
 
+# Fields of resource.struct_rusage (without the ru_ prefix) accounted for jobs
+RESOURCE_USAGE_FIELDS = ('utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw', 'nivcsw')
+# Attempts at committing resource usage; jobs finishing at the same time conflict on the totals.
+RESOURCE_USAGE_ATTEMPTS = 5
+
+
+def rusage_dict(rusage):
+    """Return the accounted fields of *rusage* (a `resource.struct_rusage`) as a dictionary."""
+    return {field: getattr(rusage, 'ru_' + field) for field in RESOURCE_USAGE_FIELDS}
+
+
+def accumulate_resource_usage(total, usage):
+    """
+    Add resource *usage* to *total* (both dictionaries, cf. `rusage_dict`) and return *total*.
+
+    The maximum RSS is the maximum of both, everything else is summed up.
+    """
+    for field, value in usage.items():
+        if field == 'maxrss':
+            total[field] = max(total.get(field, 0), value)
+        else:
+            total[field] = total.get(field, 0) + value
+    return total
+
+
+def active_jobs_of(config):
+    """Return the queued or running jobs created from *config* (eg. a BackupConfig), oldest first."""
+    job_ids = data_root().active_jobs_by_config.get(config._p_oid, ())
+    jobs = (data_root().jobs.get(job_id) for job_id in job_ids)
+    return [job for job in jobs if job is not None and not job.finished]
+
+
+def _job_committed(success, job_id):
+    if success:
+        from ..daemon.client import notify_job_created
+        notify_job_created(job_id)
+
+
 class JobExecutor:
     name = 'job-executor'
 
     @classmethod
-    def can_run(cls, job):
-        blocking_jobs = []
-        if job.repository:
-            for other_job in job.repository.jobs.values():
-                if other_job.state in Job.State.STABLE:
-                    continue
-                blocking_jobs.append(other_job)
-                hook.borgcube_job_blocked(job=job, blocking_jobs=blocking_jobs)
+    def can_run(cls, job, active_jobs=None):
+        """
+        Return whether *job* can run now.
+
+        *active_jobs* are the other active jobs using the repository of *job*, as tracked by borgcubed.
+        If not given they are looked up from the repository, which considers all jobs ever run on it.
+        """
+        if active_jobs is None:
+            active_jobs = []
+            if job.repository:
+                active_jobs = [other_job for other_job in job.repository.jobs.values()
+                               if other_job.state not in Job.State.STABLE and other_job != job]
+        blocking_jobs = [other_job for other_job in active_jobs if cls.conflicts(job, other_job)]
+        hook.borgcube_job_blocked(job=job, blocking_jobs=blocking_jobs)
         if blocking_jobs:
             log.debug('Job %s blocked by running backup jobs: %s',
                       job.id, ' '.join('{} ({})'.format(job.id, job.state) for job in blocking_jobs))
         return not blocking_jobs
 
+    @classmethod
+    def conflicts(cls, job, other_job):
+        """
+        Return whether *job* can't run while *other_job* (active, same repository) is running.
+
+        Jobs in one of their `Job.State.PREPARATION` states don't use the repository. Hence a job
+        that is about to be prepared only conflicts with other jobs being prepared, while anything else
+        only conflicts with the jobs actually using the repository.
+        """
+        if job.state == job.State.job_created and job.State.PREPARATION:
+            return other_job.state in other_job.State.PREPARATION
+        return other_job.state not in other_job.State.PREPARATION
+
     @classmethod
     def prefork(cls, job):
         pass
@@ -609,11 +723,31 @@ class Job(Evolvable):
     2. Define additional states, if necessary, by deriving the State class in your model from `Job.State`
     3. borgcubed needs to know how to run the job, therefore set *executor* to your *JobExecutor* subclass.
     4. Relevant hooks: `borgcube_job_blocked`, `borgcubed_job_exit`.
+
+    Jobs can be executed in multiple stages: if the executor leaves the job in one of the *STAGED* states
+    of its State class, the daemon queues the job again, and the next stage runs in a new worker.
+    The *PREPARATION* states denote the states in which the job does not use the repository yet,
+    so that it may run ahead of other jobs holding the repository.
     """
     short_name = 'job'
 
     executor = JobExecutor
 
+    # The job is not started before this time (datetime), if set.
+    not_before = None
+
+    # Queued jobs with a higher priority are dispatched first (cf. JOB_PRIORITY_AGING).
+    priority = 0
+
+    # The job only starts within this TimeWindow, if set, and only if it is expected to finish in it.
+    window = None
+
+    # The job only starts after these jobs (a PersistentList) finished, successfully or not, if set.
+    predecessors = None
+
+    # Process kind ('worker', 'proxy') -> resource usage (see account_resource_usage)
+    resource_usage = None
+
     class State:
         job_created = s('job_created', _('Job created'))
         done = s('done', _('Finished'))
@@ -621,6 +755,10 @@ class Job(Evolvable):
         cancelled = s('cancelled', _('Cancelled'))
 
         STABLE = {job_created, done, failed, cancelled}
+        # States in which the job doesn't need its repository yet.
+        PREPARATION = frozenset()
+        # States in which the job waits to be queued for its next stage (subset of PREPARATION).
+        STAGED = frozenset()
 
         @classmethod
         def verbose_name(cls, name):
@@ -636,6 +774,7 @@ class Job(Evolvable):
         if repository:
             repository.jobs[self.id] = self
         data_root().jobs_by_state[self.state][self.id] = self
+        transaction.get().addAfterCommitHook(_job_committed, args=(self.id,))
 
     @property
     def duration(self):
@@ -644,6 +783,10 @@ class Job(Evolvable):
         else:
             return timezone.now() - (self.timestamp_start or self.created)
 
+    def expected_duration(self):
+        """Return how long (timedelta) this job is expected to take, based on similar past jobs, or None."""
+        return None
+
     @property
     def failed(self):
         return self.state == self.State.failed
@@ -656,6 +799,14 @@ class Job(Evolvable):
     def stable(self):
         return self.state in self.State.STABLE
 
+    @property
+    def finished(self):
+        return self.state in self.State.STABLE and self.state != self.State.job_created
+
+    def waiting_for(self):
+        """Return the predecessors of this job which didn't finish yet."""
+        return [job for job in self.predecessors or () if not job.finished]
+
     def update_state(self, previous, to):
         with transaction.manager as txn:
             if self.state != previous:
@@ -667,8 +818,11 @@ class Job(Evolvable):
             data_root().jobs_by_state[self.state][self.id] = self
             self._check_set_start_timestamp(previous)
             self._check_set_end_timestamp()
+            self._update_config_index()
             log.debug('%s: phase %s -> %s', self.id, previous, to)
             txn.note('Job %s state update: %s -> %s' % (self.id, previous, to))
+        from ..daemon.utils import heartbeat
+        heartbeat(self.id)
         borgcube.utils.hook.borgcube_job_post_state_update(job=self, prior_state=previous, current_state=to)
 
     def force_state(self, state):
@@ -681,12 +835,12 @@ class Job(Evolvable):
             self.state = state
             data_root().jobs_by_state[self.state][self.id] = self
             self._check_set_end_timestamp()
+            self._update_config_index()
             txn.note('Job %s forced to state %s' % (self.id, state))
         borgcube.utils.hook.borgcube_job_post_force_state(job=self, forced_state=state)
         return True
 
     def set_failure_cause(self, kind, **kwargs):
-        borgcube.utils.hook.borgcube_job_failure_cause(job=self, kind=kind, kwargs=kwargs)
         self.force_state(self.State.failed)
         self.failure_cause = {
             'kind': kind,
@@ -694,6 +848,24 @@ class Job(Evolvable):
         self.failure_cause.update(kwargs)
         transaction.get().note('Set failure cause of job %s to %s' % (self.id, kind))
         transaction.commit()
+        borgcube.utils.hook.borgcube_job_failure_cause(job=self, kind=kind, kwargs=kwargs)
+
+    def account_resource_usage(self, kind, usage):
+        """
+        Add resource *usage* (a dictionary, see `rusage_dict`) of a process of *kind* ('worker' or 'proxy')
+        to this job, and to the totals of its repository and client.
+
+        The caller is responsible for committing, and for retrying on conflicts (the totals are shared
+        with other jobs, see RESOURCE_USAGE_ATTEMPTS).
+        """
+        if self.resource_usage is None:
+            self.resource_usage = PersistentDict()
+        self.resource_usage[kind] = accumulate_resource_usage(dict(self.resource_usage.get(kind, {})), usage)
+        for owner in (self.repository, getattr(self, 'client', None)):
+            if owner is None:
+                continue
+            owner.resource_usage[self.short_name] = accumulate_resource_usage(
+                dict(owner.resource_usage.get(self.short_name, {})), usage)
 
     def log_path(self):
         short_timestamp = self.created.replace(microsecond=0).isoformat()
@@ -713,6 +885,23 @@ class Job(Evolvable):
         except OSError:
             pass
 
+    def _update_config_index(self):
+        """Update the entry of the config of this job (if any) in DataRoot.active_jobs_by_config."""
+        config = getattr(self, 'config', None)
+        if config is None or not config._p_oid:
+            return
+        index = data_root().active_jobs_by_config
+        job_ids = index.get(config._p_oid)
+        if not self.finished:
+            if job_ids is None:
+                job_ids = index[config._p_oid] = LLTreeSet()
+            job_ids.add(self.id)
+        elif job_ids is not None and self.id in job_ids:
+            # Other jobs of the config (eg. a manual and a scheduled run) may still be active.
+            job_ids.remove(self.id)
+            if not job_ids:
+                del index[config._p_oid]
+
     def _check_set_start_timestamp(self, from_state):
         if from_state == self.State.job_created:
             self.timestamp_start = timezone.now()
@@ -764,9 +953,54 @@ class Trigger(Evolvable):
         self.trigger_ids = PersistentList()
 
 
+class TimeWindow:
+    """A daily window of local time (eg. 22:00 to 06:00) in which jobs may start (see Job.window)."""
+
+    def __init__(self, start, end):
+        # datetime.time instances; if *end* is before *start* the window spans midnight.
+        self.start = start
+        self.end = end
+
+    def __str__(self):
+        return '%s–%s' % (self.start.strftime('%H:%M'), self.end.strftime('%H:%M'))
+
+    @property
+    def length(self):
+        minutes = (self.end.hour * 60 + self.end.minute) - (self.start.hour * 60 + self.start.minute)
+        return datetime.timedelta(minutes=minutes % (24 * 60) or 24 * 60)
+
+    def current(self, moment):
+        """Return (opens, closes) of the window containing *moment*, or of the next one."""
+        local = timezone.localtime(moment)
+        opens = local.replace(hour=self.start.hour, minute=self.start.minute, second=0, microsecond=0)
+        if opens > local:
+            opens -= datetime.timedelta(days=1)
+        if opens + self.length <= local:
+            opens += datetime.timedelta(days=1)
+        return opens, opens + self.length
+
+
+def time_window(start, end):
+    """Return a TimeWindow from *start* to *end*, or None if either is unset."""
+    if start and end:
+        return TimeWindow(start, end)
+
+
+def validate_time_window(cleaned_data):
+    if bool(cleaned_data.get('window_start')) != bool(cleaned_data.get('window_end')):
+        raise ValidationError(_('Set both the start and the end of the time window, or neither.'))
+
+
 class Schedule(Evolvable):
     version = 4
 
+    # Jobs created by this schedule only start within this window (unless their configuration defines one).
+    window_start = None
+    window_end = None
+
+    # The occurence last executed by borgcubed (see borgcube.daemon.scheduler)
+    last_occurence = None
+
     @evolve(1, 2)
     def make_dtstart_implicit(self):
         self.recurrence.dtstart = self.recurrence_start
@@ -780,18 +1014,40 @@ class Schedule(Evolvable):
     def add_trigger(self):
         self.trigger = Trigger(self.run_from_trigger)
 
-    def __init__(self, name, recurrence, recurrence_enabled=True, description=''):
+    def __init__(self, name, recurrence, recurrence_enabled=True, description='', window_start=None, window_end=None):
         self.name = name
         self.description = description
 
         self.recurrence = recurrence
         self.recurrence_enabled = recurrence_enabled
+        self.window_start = window_start
+        self.window_end = window_end
 
         self.actions = PersistentList()
 
     def run_from_trigger(self):
         pass
 
+    @property
+    def occurences(self):
+        """The `RecurrenceEvaluator` of this schedule (kept until the schedule is changed or unloaded)."""
+        evaluator = getattr(self, '_v_occurences', None)
+        if not evaluator or evaluator.recurrence is not self.recurrence:
+            evaluator = self._v_occurences = RecurrenceEvaluator(self.recurrence)
+        return evaluator
+
+    @property
+    def window(self):
+        return time_window(self.window_start, self.window_end)
+
+    def after(self, moment, inc=False):
+        """Return the first occurence after *moment*, or None."""
+        return self.occurences.after(moment, inc)
+
+    def between(self, after, before, inc=False):
+        """Return the occurences between *after* and *before*."""
+        return self.occurences.between(after, before, inc)
+
     class Form(forms.Form):
         name = forms.CharField()
         description = forms.CharField(required=False, initial='', widget=forms.Textarea)
@@ -807,6 +1063,11 @@ class Schedule(Evolvable):
         )
         recurrence = RecurrenceField(required=False)
 
+        window_start = forms.TimeField(required=False, label=_('Start jobs from'))
+        window_end = forms.TimeField(required=False, label=_('Start jobs until'),
+                                     help_text=_('Jobs of this schedule are only started in this time window, '
+                                                 'if they are expected to finish before it closes.'))
+
         def __init__(self, data, *args, **kwargs):
             super().__init__(data, *args, **kwargs)
             if 'recurrence' in self.initial:
@@ -814,6 +1075,7 @@ class Schedule(Evolvable):
 
         def clean(self):
             super().clean()
+            validate_time_window(self.cleaned_data)
             if not self.errors:
                 dtstart = self.cleaned_data.pop('recurrence_start')
                 self.cleaned_data['recurrence'].dtstart = dtstart
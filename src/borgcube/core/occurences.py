@@ -0,0 +1,92 @@
+"""
+Evaluation of schedule recurrences (django-recurrence) that doesn't get slower as schedules age.
+
+rrule evaluation is linear in the distance from DTSTART, since all intermediary occurences are computed.
+For rules repeating with a fixed period (eg. every six hours, or every other week on Monday and Friday)
+DTSTART can be moved forward by a multiple of the period without changing the series, so that evaluation
+starts close to the requested time. Other rules are evaluated from their original DTSTART.
+"""
+
+import datetime
+
+from dateutil import rrule
+
+# Length of the fixed-period frequencies
+PERIODS = {
+    rrule.WEEKLY: datetime.timedelta(weeks=1),
+    rrule.DAILY: datetime.timedelta(days=1),
+    rrule.HOURLY: datetime.timedelta(hours=1),
+    rrule.MINUTELY: datetime.timedelta(minutes=1),
+    rrule.SECONDLY: datetime.timedelta(seconds=1),
+}
+
+# These make the series depend on the month or year, so it isn't periodic anymore.
+CALENDAR_PARAMS = ('bymonth', 'bymonthday', 'byyearday', 'byweekno')
+
+
+def recurrence_period(recurrence):
+    """
+    Return the period (timedelta) after which *recurrence* repeats itself, or None if it's not
+    a single rule with a fixed period.
+    """
+    if len(recurrence.rrules) != 1 or recurrence.exrules or recurrence.rdates or recurrence.exdates:
+        return None
+    rule = recurrence.rrules[0]
+    if rule.freq not in PERIODS or rule.count:
+        return None
+    if any(getattr(rule, param, None) for param in CALENDAR_PARAMS):
+        return None
+    return PERIODS[rule.freq] * (rule.interval or 1)
+
+
+class RecurrenceEvaluator:
+    """
+    Evaluate a recurrence (*after*, *between*), with DTSTART moved forward for periodic rules.
+
+    Occurences are expanded for a window (at least *window* long, but at most *max_occurences* periods) and
+    cached, so that consecutive queries, like those of the scheduler or for the days of a calendar,
+    are mostly answered from the cache.
+    """
+    window = datetime.timedelta(days=7)
+    max_occurences = 1000
+
+    def __init__(self, recurrence):
+        self.recurrence = recurrence
+        self.period = recurrence_period(recurrence)
+        if self.period:
+            self.window = min(self.window, self.period * self.max_occurences)
+        # Occurences in [window_start, window_end]
+        self.window_start = self.window_end = None
+        self.occurences = []
+
+    def dtstart_before(self, moment):
+        """Return a DTSTART equivalent to the original one for occurences after *moment*, or None for the original."""
+        dtstart = self.recurrence.dtstart
+        if not self.period or not dtstart or (dtstart.tzinfo is None) != (moment.tzinfo is None):
+            return None
+        # Keep well clear of *moment*: DTSTART is an occurence itself, and DST changes shift wall clock time.
+        margin = max(self.period, datetime.timedelta(hours=2))
+        periods = (moment - dtstart - margin) // self.period
+        if periods <= 0:
+            return None
+        return dtstart + periods * self.period
+
+    def expand(self, start, end):
+        """Return the occurences in [start, end] (and possibly more)."""
+        if self.window_start is None or start < self.window_start or end > self.window_end:
+            end = max(end, start + self.window)
+            self.occurences = self.recurrence.between(start, end, inc=True, dtstart=self.dtstart_before(start))
+            self.window_start, self.window_end = start, end
+        return self.occurences
+
+    def between(self, after, before, inc=False):
+        if inc:
+            return [occurence for occurence in self.expand(after, before) if after <= occurence <= before]
+        return [occurence for occurence in self.expand(after, before) if after < occurence < before]
+
+    def after(self, moment, inc=False):
+        for occurence in self.expand(moment, moment):
+            if occurence > moment or (inc and occurence == moment):
+                return occurence
+        # Nothing in the window
+        return self.recurrence.after(moment, inc=inc, dtstart=self.dtstart_before(moment))
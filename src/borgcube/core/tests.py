@@ -1,12 +1,19 @@
 
+import datetime
 from pathlib import Path
 from subprocess import check_call
 
 import pytest
 
+import recurrence
+
 import transaction
 
-from .models import Client, Repository, Job, PersistentDefaultDict, NumberTree
+from django.utils import timezone
+
+from .models import Client, Repository, Job, PersistentDefaultDict, NumberTree, RshClientConnection
+from .models import accumulate_resource_usage, active_jobs_of, TimeWindow
+from .occurences import RecurrenceEvaluator, recurrence_period
 from ..utils import data_root
 
 
@@ -87,6 +94,35 @@ def test_job_force_state(job):
     assert job.state == Job.State.failed
 
 
+def test_job_waiting_for():
+    prune, check = Job(), Job()
+    job = Job()
+    assert job.waiting_for() == []
+    job.predecessors = [prune, check]
+    assert job.waiting_for() == [prune, check]
+    prune.force_state(Job.State.done)
+    assert job.waiting_for() == [check]
+    # Failed predecessors are finished as well, they don't hold up their dependents.
+    check.force_state(Job.State.failed)
+    assert job.waiting_for() == []
+
+
+def test_active_jobs_of_overlapping():
+    with transaction.manager:
+        config = data_root().config = PersistentDefaultDict(factory=None)
+    manual, scheduled = Job(), Job()
+    for job in manual, scheduled:
+        job.config = config
+        job._update_config_index()
+    assert active_jobs_of(config) == [manual, scheduled]
+    # The newer job finishing first must not hide the older one, which is still running.
+    scheduled.force_state(Job.State.done)
+    assert active_jobs_of(config) == [manual]
+    manual.force_state(Job.State.failed)
+    assert active_jobs_of(config) == []
+    assert config._p_oid not in data_root().active_jobs_by_config
+
+
 def test_backup_job_archive_name(backup_job):
     assert backup_job.archive_name == 'testhost-%s' % backup_job.id
     assert 'UUID' not in backup_job.archive_name
@@ -139,3 +175,70 @@ class TestNumberTree:
 
         t[1] = 'umph'
         assert t[1] == 'umph'
+
+
+class TestRshClientConnection:
+    def test_rsh_command(self):
+        connection = RshClientConnection('root@testhost', rsh_options='-p 2222 -o "Compression yes"',
+                                         ssh_identity_file='/id_testhost')
+        assert connection.rsh_command() == ['ssh', '-i', '/id_testhost', '-p', '2222', '-o', 'Compression yes']
+        assert connection.rsh_command(control_path='/ctl')[-2:] == ['-o', 'ControlPath=/ctl']
+
+    def test_rsh_command_no_openssh(self):
+        connection = RshClientConnection('root@testhost', rsh='/usr/bin/rsh')
+        assert connection.rsh_command(control_path='/ctl') == ['/usr/bin/rsh']
+
+
+def test_accumulate_resource_usage():
+    total = accumulate_resource_usage({}, {'utime': 1.5, 'maxrss': 1000, 'nvcsw': 10})
+    total = accumulate_resource_usage(total, {'utime': 2.0, 'maxrss': 500, 'nvcsw': 5})
+    assert total == {'utime': 3.5, 'maxrss': 1000, 'nvcsw': 15}
+
+
+class TestRecurrenceEvaluator:
+    dtstart = datetime.datetime(2010, 1, 6, 3, 30)
+
+    def recurrence(self, **kwargs):
+        return recurrence.Recurrence(dtstart=self.dtstart, rrules=[recurrence.Rule(**kwargs)])
+
+    def test_period(self):
+        assert recurrence_period(self.recurrence(freq=recurrence.HOURLY, interval=6)) == datetime.timedelta(hours=6)
+        assert recurrence_period(self.recurrence(freq=recurrence.MONTHLY)) is None
+        assert recurrence_period(self.recurrence(freq=recurrence.DAILY, bymonthday=1)) is None
+        assert recurrence_period(self.recurrence(freq=recurrence.DAILY, count=10)) is None
+
+    @pytest.mark.parametrize('rule', [
+        dict(freq=recurrence.HOURLY, interval=5),
+        dict(freq=recurrence.WEEKLY, interval=2, byday=[recurrence.MO, recurrence.FR]),
+        dict(freq=recurrence.MONTHLY, bymonthday=15),
+    ])
+    def test_same_occurences(self, rule):
+        rec = self.recurrence(**rule)
+        evaluator = RecurrenceEvaluator(rec)
+        moment = datetime.datetime(2017, 3, 14, 15, 9, 26)
+        assert evaluator.after(moment) == rec.after(moment)
+        day = datetime.timedelta(days=1)
+        for i in range(40):
+            begin = moment + i * day
+            assert evaluator.between(begin, begin + day, inc=True) == rec.between(begin, begin + day, inc=True)
+
+
+class TestTimeWindow:
+    window = TimeWindow(datetime.time(22), datetime.time(6))
+
+    def local(self, *args):
+        return timezone.make_aware(datetime.datetime(*args))
+
+    def test_length(self):
+        assert self.window.length == datetime.timedelta(hours=8)
+        assert TimeWindow(datetime.time(1), datetime.time(1)).length == datetime.timedelta(hours=24)
+
+    @pytest.mark.parametrize('moment, opens', [
+        ((2017, 3, 14, 23), (2017, 3, 14, 22)),
+        ((2017, 3, 15, 3), (2017, 3, 14, 22)),
+        ((2017, 3, 15, 12), (2017, 3, 15, 22)),
+        ((2017, 3, 15, 6), (2017, 3, 15, 22)),
+    ])
+    def test_current(self, moment, opens):
+        assert self.window.current(self.local(*moment)) == (self.local(*opens),
+                                                            self.local(*opens) + datetime.timedelta(hours=8))
@@ -0,0 +1,143 @@
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import zmq
+
+from django.conf import settings
+
+from ..core.models import rusage_dict
+from ..utils import set_process_name, reset_db_connection, log_to_daemon
+from .client import APIClient
+from .server import APIServer, exit_by_exception
+from .utils import last_heartbeat, remove_heartbeat
+
+log = logging.getLogger('borgcubed.agent')
+
+
+class WorkerAgent:
+    """
+    Worker agent (borgcubed --worker) running jobs dispatched by the main borgcubed, usually on another host.
+
+    The agent polls the main daemon (agent-poll command) every *poll_interval* seconds, advertising its
+    capacity and the repositories it can reach, reporting finished jobs and receiving the jobs it
+    is to run. The jobs are run just like borgcubed runs them, in a forked worker per job.
+    """
+    poll_interval = 1
+
+    def __init__(self, context=None):
+        if not settings.AGENT_CONNECT:
+            log.error('AGENT_CONNECT is not configured.')
+            sys.exit(1)
+        self.context = context or zmq.Context.instance()
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.client = APIClient(settings.AGENT_CONNECT['api'], self.context)
+        # PID -> job ID
+        self.children = {}
+        # Reports of finished jobs, sent with the next poll
+        self.finished = []
+        # IDs of jobs already cancelled; borgcubed repeats cancellations until the job finished
+        self.cancelled = set()
+        self.shutdown = False
+        signal.signal(signal.SIGTERM, self.signal_terminate)
+        signal.signal(signal.SIGINT, self.signal_terminate)
+
+    def signal_terminate(self, signum, stack_frame):
+        log.info('Received signal %d, shutting down', signum)
+        self.shutdown = True
+        signal.signal(signum, signal.SIG_IGN)
+
+    def main_loop(self):
+        set_process_name('borgcubed [worker agent]')
+        log.info('Worker agent %s reporting for duty (capacity %d)', self.name, settings.AGENT_CAPACITY)
+        while not self.shutdown:
+            self.reap()
+            self.poll()
+            time.sleep(self.poll_interval)
+        log.debug('Killing children')
+        for pid in self.children:
+            os.killpg(pid, signal.SIGTERM)
+        while self.children:
+            self.reap(block=True)
+        self.poll(capacity=0)
+        log.info('Worker agent %s signing off', self.name)
+
+    def poll(self, capacity=None):
+        if capacity is None:
+            capacity = settings.AGENT_CAPACITY
+        try:
+            reply = self.client.do_request({
+                'command': 'agent-poll',
+                'agent': self.name,
+                'capacity': capacity,
+                'repositories': settings.AGENT_REPOSITORIES,
+                'running': list(self.children.values()),
+                'finished': self.finished,
+                'heartbeats': self.heartbeats(),
+            })
+        except zmq.ZMQError as exc:
+            log.warning('Could not reach borgcubed: %s', exc)
+            # A REQ socket can't recover from a lost reply.
+            self.client.socket.close(linger=0)
+            self.client = APIClient(settings.AGENT_CONNECT['api'], self.context)
+            return
+        if not reply['success']:
+            log.error('Poll failed: %s', reply['message'])
+            return
+        self.finished = []
+        self.cancelled &= set(self.children.values())
+        for job_id in reply['cancel']:
+            if job_id in self.cancelled:
+                continue
+            self.cancelled.add(job_id)
+            for pid, child_job_id in self.children.items():
+                if child_job_id == job_id:
+                    log.info('Cancelling job %s (worker pid is %d)', job_id, pid)
+                    os.killpg(pid, signal.SIGTERM)
+        for job_id in reply['jobs']:
+            self.run_job(job_id)
+
+    def heartbeats(self):
+        """Return the seconds since the last heartbeat of the running jobs, keyed by job ID."""
+        ages = {}
+        for job_id in self.children.values():
+            beat = last_heartbeat(job_id)
+            if beat is not None:
+                ages[job_id] = time.time() - beat
+        return ages
+
+    def run_job(self, job_id):
+        pid = os.fork()
+        if pid:
+            log.debug('Forked worker PID %d for job %s', pid, job_id)
+            self.children[pid] = job_id
+            return
+        os.setpgrp()
+        exit_by_exception()
+        log_to_daemon(settings.AGENT_CONNECT['log'])()
+        reset_db_connection()
+        APIServer.run_job(job_id)
+
+    def reap(self, block=False):
+        flags = 0 if block else os.WNOHANG
+        while self.children:
+            pid, waitres, rusage = os.wait4(-1, flags)
+            flags = os.WNOHANG
+            if not pid:
+                break
+            signo = waitres & 0xFF
+            code = (waitres & 0xFF00) >> 8
+            job_id = self.children.pop(pid, None)
+            if job_id is None:
+                continue
+            remove_heartbeat(job_id)
+            (log.error if code or signo else log.debug)('Worker %d of job %s exited with code %d (signal %d)',
+                                                        pid, job_id, code, signo)
+            self.finished.append({
+                'job_id': job_id,
+                'failed': bool(code or signo),
+                'rusage': rusage_dict(rusage),
+            })
@@ -1,5 +1,7 @@
 
+import json
 import logging
+import os
 
 from django.conf import settings
 
@@ -15,6 +17,36 @@ class APIError(RuntimeError):
     pass
 
 
+# Set in the main process of borgcubed, which doesn't need to send requests to itself.
+job_created_callback = None
+
+
+def notify_job_created(job_id):
+    """
+    Tell borgcubed that the job *job_id* was created (and committed), so that it is queued right away.
+
+    Failures are not fatal: borgcubed also looks for new jobs periodically. Hence this doesn't wait for
+    the reply, nor for long if borgcubed doesn't take the message.
+    """
+    if job_created_callback:
+        job_created_callback(job_id)
+        return
+    address = get_socket_addr('daemon')
+    if not os.path.exists(address):
+        return
+    socket = zmq.Context.instance().socket(zmq.DEALER)
+    socket.sndtimeo = 200
+    socket.linger = 200
+    try:
+        socket.connect('ipc://' + address)
+        # The empty delimiter frame makes this look like a request of a REQ socket to borgcubed.
+        socket.send_multipart([b'', json.dumps({'command': 'job-created', 'job_id': job_id}).encode()])
+    except zmq.ZMQError as exc:
+        log.debug('Could not notify borgcubed of new job %s: %s', job_id, exc)
+    finally:
+        socket.close()
+
+
 class APIClient:
     """
     Client to talk to the backend daemon (borgcubed)
@@ -54,5 +86,26 @@ class APIClient:
             raise APIError(reply['message'])
         log.info('Cancelled job %s', job.id)
 
+    def job_created(self, job_id):
+        reply = self.do_request({
+            'command': 'job-created',
+            'job_id': job_id,
+        })
+        if not reply['success']:
+            raise APIError(reply['message'])
+
+    def close(self):
+        self.socket.close(linger=0)
+
+    def metrics(self):
+        reply = self.do_request({'command': 'metrics'})
+        if not reply['success']:
+            raise APIError(reply['message'])
+        return reply['metrics']
+
+    def restart(self):
+        """Restart borgcubed. Running jobs are handed over to the new daemon."""
+        return self.do_request({'command': 'restart'})
+
     def stats(self):
         return self.do_request({'command': 'stats'})['stats']
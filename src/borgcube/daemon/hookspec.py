@@ -18,6 +18,9 @@ def borgcubed_startup(apiserver):
 
     def queue_job(self, job):
         Enqueue *job* instance for execution.
+
+    def wakeup_in(self, seconds):
+        Make sure that the idle hook is called in *seconds* (or earlier).
     """
 
 
@@ -27,13 +30,20 @@ def borgcubed_handle_request(apiserver, request):
     Handle *request* and return a response dictionary.
 
     request['command'] is the command string. If this is not for you, return None.
+
+    This is called in a thread of the request pool of the daemon, not in its main loop, and may be called
+    concurrently. Don't modify *apiserver* from here, use ``apiserver.call_in_main_loop(function, *args)`` for that;
+    `data_root` gives every thread its own database connection. Creating jobs is fine.
     """
 
 
 @hookspec
 def borgcubed_idle(apiserver):
     """
-    Called on every 'idle' iteration in the daemon. This typically occurs roughly every second.
+    Called on every 'idle' iteration in the daemon. This occurs when a child process exits, and otherwise
+    at least every `BaseServer.idle_interval` seconds.
+
+    Call ``apiserver.wakeup_in(seconds)`` if you need to be called again at a specific time.
     """
 
 
@@ -0,0 +1,138 @@
+import heapq
+import itertools
+from collections import OrderedDict, defaultdict
+
+
+class JobQueue:
+    """
+    The job queue of the daemon.
+
+    Queued jobs are kept in FIFO run queues per repository. The active jobs (dispatched, but not finished yet)
+    are indexed per repository as well, so that deciding whether a job can run only needs to consider
+    the active jobs of its repository, instead of all jobs of the repository.
+
+    Run queues are only re-evaluated when something changed for their repository (see `pop_dirty`).
+    """
+
+    def __init__(self):
+        # job id -> (executor_class, job), in FIFO order
+        self.queued = OrderedDict()
+        # repository key -> OrderedDict(job id -> (executor_class, job))
+        self.run_queues = defaultdict(OrderedDict)
+        # repository key -> {job id: job}
+        self.active = defaultdict(dict)
+        self.dirty = set()
+        # repository keys of run queues with jobs held back by concurrency limits
+        self.throttled = set()
+        # heap of (time, sequence number, repository key); the run queue is marked dirty at that time
+        self.timers = []
+        # repository key -> time of its earliest timer; heap entries not matching this are stale
+        self.timer_keys = {}
+        self._timer_seq = itertools.count()
+
+    @staticmethod
+    def key(job):
+        if job.repository:
+            return job.repository._p_oid
+
+    def __iter__(self):
+        return iter(list(self.queued.values()))
+
+    def __len__(self):
+        return len(self.queued)
+
+    def __contains__(self, job):
+        return job.id in self.queued
+
+    def push(self, executor_class, job):
+        """Enqueue *job*. Return whether it was not queued already."""
+        if job.id in self.queued:
+            return False
+        key = self.key(job)
+        self.queued[job.id] = self.run_queues[key][job.id] = executor_class, job
+        self.dirty.add(key)
+        return True
+
+    def remove(self, job):
+        """Remove *job* from the queue. Return whether it was queued."""
+        if self.queued.pop(job.id, None) is None:
+            return False
+        key = self.key(job)
+        run_queue = self.run_queues[key]
+        del run_queue[job.id]
+        if not run_queue:
+            del self.run_queues[key]
+        return True
+
+    def clear(self):
+        self.queued.clear()
+        self.run_queues.clear()
+        self.dirty.clear()
+        self.throttled.clear()
+        self.timers.clear()
+        self.timer_keys.clear()
+
+    def run_queue(self, key):
+        """Return a list of the (executor_class, job) tuples queued for repository *key*."""
+        return list(self.run_queues.get(key, {}).values())
+
+    def activate(self, job):
+        self.active[self.key(job)][job.id] = job
+
+    def deactivate(self, job):
+        """Remove *job* from the active jobs. Return whether it was active."""
+        key = self.key(job)
+        if self.active[key].pop(job.id, None) is None:
+            return False
+        if key is None:
+            # Jobs without a repository may block jobs on other repositories (see borgcube_job_blocked).
+            self.touch_all()
+        else:
+            self.dirty.add(key)
+        return True
+
+    def active_jobs(self, job):
+        """Return the active jobs using the repository of *job* (excluding *job*)."""
+        if not job.repository:
+            return []
+        return [other_job for id, other_job in self.active[self.key(job)].items() if id != job.id]
+
+    def touch(self, job):
+        """Re-evaluate the run queue of *job* next time."""
+        self.dirty.add(self.key(job))
+
+    def touch_all(self):
+        self.dirty.update(self.run_queues)
+
+    def throttle(self, job):
+        """Re-evaluate the run queue of *job* after `release_throttled` is called."""
+        self.throttled.add(self.key(job))
+
+    def release_throttled(self):
+        self.dirty.update(self.throttled)
+        self.throttled.clear()
+
+    def touch_at(self, job, time):
+        """
+        Re-evaluate the run queue of *job* at *time*.
+
+        Only the earliest timer of a run queue is kept; jobs waiting for a later time set their timer again
+        when the run queue is re-evaluated.
+        """
+        key = self.key(job)
+        pending = self.timer_keys.get(key)
+        if pending is not None and pending <= time:
+            return
+        self.timer_keys[key] = time
+        heapq.heappush(self.timers, (time, next(self._timer_seq), key))
+
+    def pop_dirty(self, now):
+        """Return the keys of the run queues needing evaluation at *now*, and reset them."""
+        while self.timers and self.timers[0][0] <= now:
+            time, seq, key = heapq.heappop(self.timers)
+            if self.timer_keys.get(key) == time:
+                del self.timer_keys[key]
+                self.dirty.add(key)
+        dirty = [key for key in self.dirty if key in self.run_queues]
+        self.dirty.clear()
+        return dirty
@@ -0,0 +1,152 @@
+"""
+Metrics of borgcubed in the Prometheus text format.
+
+The daemon collects them (`DaemonMetrics`) and hands them out with the *metrics* API command;
+they are served by the built-in web server (/metrics/) and optionally by the `MetricsService` of borgcubed.
+"""
+
+import logging
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+
+from .client import APIClient
+
+log = logging.getLogger('borgcubed.metrics')
+
+# Seconds
+JOB_DURATION_BUCKETS = (60, 300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 16 * 3600)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield name + '_bucket', dict(labels, le=str(bound)), count
+        yield name + '_bucket', dict(labels, le='+Inf'), self.count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class DaemonMetrics:
+    """Metrics about finished jobs, updated by the daemon as jobs finish."""
+
+    def __init__(self):
+        # (job type, state) -> count
+        self.jobs_finished = Counter()
+        # job type -> Histogram
+        self.job_durations = {}
+        # failure cause kind -> count
+        self.failure_causes = Counter()
+        # original/compressed/deduplicated -> bytes
+        self.backup_bytes = Counter()
+
+    def job_finished(self, job):
+        self.jobs_finished[job.short_name, job.state] += 1
+        if job.timestamp_start:
+            histogram = self.job_durations.setdefault(job.short_name, Histogram(JOB_DURATION_BUCKETS))
+            histogram.observe(job.duration.total_seconds())
+        failure_cause = getattr(job, 'failure_cause', None)
+        if job.failed and failure_cause:
+            self.failure_causes[failure_cause['kind']] += 1
+        archive = getattr(job, 'archive', None)
+        if job.state == job.State.done and archive:
+            self.backup_bytes['original'] += archive.original_size
+            self.backup_bytes['compressed'] += archive.compressed_size
+            self.backup_bytes['deduplicated'] += archive.deduplicated_size
+
+    def families(self, apiserver):
+        """
+        Return the metric families of *apiserver* as a list of dictionaries (name, type, help, samples),
+        where samples are (name, labels, value) tuples.
+        """
+        def family(name, type, help, samples):
+            return {'name': name, 'type': type, 'help': help, 'samples': list(samples)}
+
+        queued = Counter(job.repository.name if job.repository else '' for executor_class, job in apiserver.queue)
+        workers = Counter(job.short_name for command, job in apiserver.children.values())
+        for agent in apiserver.agents.values():
+            workers.update(job.short_name for job in agent.jobs.values())
+        histogram_samples = []
+        for job_type, histogram in sorted(self.job_durations.items()):
+            histogram_samples.extend(histogram.samples('borgcube_job_duration_seconds', {'type': job_type}))
+        return [
+            family('borgcube_uptime_seconds', 'gauge', 'Time since borgcubed started',
+                   [('borgcube_uptime_seconds', {}, apiserver.uptime)]),
+            family('borgcube_daemon_events_total', 'counter', 'Daemon counters (requests, forks, ...)',
+                   (('borgcube_daemon_events_total', {'event': event}, value)
+                    for event, value in sorted(apiserver.stats.items()))),
+            family('borgcube_queued_jobs', 'gauge', 'Queued jobs per repository',
+                   (('borgcube_queued_jobs', {'repository': repository}, count)
+                    for repository, count in sorted(queued.items()))),
+            family('borgcube_running_workers', 'gauge', 'Running workers per job type',
+                   (('borgcube_running_workers', {'type': job_type}, count)
+                    for job_type, count in sorted(workers.items()))),
+            family('borgcube_idle_workers', 'gauge', 'Idle pre-initialized workers',
+                   [('borgcube_idle_workers', {}, len(apiserver.idle_workers))]),
+            family('borgcube_jobs_finished_total', 'counter', 'Finished jobs per type and final state',
+                   (('borgcube_jobs_finished_total', {'type': job_type, 'state': state}, count)
+                    for (job_type, state), count in sorted(self.jobs_finished.items()))),
+            family('borgcube_job_duration_seconds', 'histogram', 'Duration of finished jobs', histogram_samples),
+            family('borgcube_job_failures_total', 'counter', 'Failed jobs per failure cause',
+                   (('borgcube_job_failures_total', {'cause': kind}, count)
+                    for kind, count in sorted(self.failure_causes.items()))),
+            family('borgcube_backup_bytes_total', 'counter', 'Data backed up by finished backup jobs',
+                   (('borgcube_backup_bytes_total', {'kind': kind}, count)
+                    for kind, count in sorted(self.backup_bytes.items()))),
+        ]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render_metrics(families):
+    """Render metric *families* (see `DaemonMetrics.families`) in the Prometheus text format."""
+    lines = []
+    for family in families:
+        lines.append('# HELP %s %s' % (family['name'], family['help']))
+        lines.append('# TYPE %s %s' % (family['name'], family['type']))
+        for name, labels, value in family['samples']:
+            if labels:
+                name += '{%s}' % ','.join('%s="%s"' % (label, _escape(labels[label])) for label in sorted(labels))
+            lines.append('%s %s' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        client = APIClient()
+        try:
+            body = render_metrics(client.metrics()).encode()
+        except Exception as exc:
+            log.error('Could not get metrics from borgcubed: %s', exc)
+            self.send_error(503)
+            return
+        finally:
+            client.close()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
@@ -1,55 +1,116 @@
 import datetime
+import heapq
+import itertools
 import logging
-import signal
-from functools import partial
 
-from django.utils.module_loading import import_string
+from django.conf import settings
 from django.utils.timezone import now
 
-from borgcube.core.models import Schedule, ScheduledAction
+import transaction
+
 from borgcube.utils import data_root
 
 log = logging.getLogger('borgcubed.scheduler')
 
-latest_executions = {}
 
+class Timetable:
+    """
+    The next occurences of the schedules, as a min-heap.
+
+    Evaluating a recurrence is costly, so the next occurence of a schedule is only computed
+    when its previous occurence fired or the schedule changed (which is noticed by its ZODB serial).
+    """
+
+    def __init__(self):
+        # heap of (occurence, sequence number, schedule oid)
+        self.heap = []
+        # schedule oid -> (serial, next occurence); heap entries not matching this are stale
+        self.entries = {}
+        self._seq = itertools.count()
+        self.initialized = False
+
+    def update(self, schedules, moment, earliest=None):
+        """
+        Update the timetable for the changes of *schedules* (the list of all schedules) since the last call.
+
+        On the first call schedules are planned from the occurence they last executed, but not before *earliest*,
+        so that an occurence missed while borgcubed wasn't running is due right away.
+        """
+        current = set()
+        for schedule in schedules:
+            if not schedule.recurrence_enabled:
+                continue
+            current.add(schedule._p_oid)
+            entry = self.entries.get(schedule._p_oid)
+            if not entry or entry[0] != schedule._p_serial:
+                log.debug('Computing next occurence of schedule %s', schedule.name)
+                since = moment
+                if not self.initialized and schedule.last_occurence and earliest is not None:
+                    since = max(schedule.last_occurence, earliest)
+                self.plan(schedule, since)
+        for oid in set(self.entries) - current:
+            del self.entries[oid]
+        self.initialized = True
+
+    def plan(self, schedule, moment):
+        """Enter the next occurence of *schedule* after *moment*."""
+        occurence = schedule.after(moment)
+        self.entries[schedule._p_oid] = schedule._p_serial, occurence
+        if occurence:
+            heapq.heappush(self.heap, (occurence, next(self._seq), schedule._p_oid))
 
-# def borgcubed_startup(apiserver):
-#    signal.signal(signal.SIGALRM, partial(schedule_sweep, apiserver))
+    def pop_due(self, moment):
+        """Remove and return (schedule oid, occurence) of the occurences up to *moment*."""
+        due = []
+        while self.heap and self.heap[0][0] <= moment:
+            occurence, seq, oid = heapq.heappop(self.heap)
+            entry = self.entries.get(oid)
+            if entry and entry[1] == occurence:
+                due.append((oid, occurence))
+        return due
+
+    def next_occurence(self):
+        """Return the earliest occurence in the timetable, or None."""
+        while self.heap:
+            occurence, seq, oid = self.heap[0]
+            entry = self.entries.get(oid)
+            if entry and entry[1] == occurence:
+                return occurence
+            heapq.heappop(self.heap)
+
+
+timetable = Timetable()
 
 
 def borgcubed_idle(apiserver):
     """Check schedule. Are we supposed to do something right about now?"""
-#    seconds = seconds_until_next_occurence()
-#    log.debug('setting alarm clock to beep in %d seconds', seconds)
-#    signal.alarm(seconds)
     this_very_moment = now()
-    for schedule in data_root().schedules:
-        if not schedule.recurrence_enabled:
-            continue
-        # TODO: when django-recurrence#81 is resolved, use cache.
-        occurence = schedule.recurrence.after(this_very_moment)
-        if latest_executions.get(schedule._p_oid) == occurence:
-            continue
-        if occurence and abs((occurence - this_very_moment).total_seconds()) < 10:
-            latest_executions[schedule._p_oid] = occurence
-            execute(apiserver, schedule)
+    earliest = this_very_moment - datetime.timedelta(seconds=settings.SCHEDULE_CATCH_UP)
+    schedules = data_root().schedules
+    timetable.update(schedules, this_very_moment, earliest)
+    # Each schedule is executed at most once, even if several of its occurences were missed.
+    due = timetable.pop_due(this_very_moment)
+    if due:
+        by_oid = {schedule._p_oid: schedule for schedule in schedules}
+        for oid, occurence in due:
+            schedule = by_oid[oid]
+            if occurence < earliest:
+                log.warning('Skipping occurence %s of schedule %s, it is long past', occurence, schedule.name)
+            else:
+                if (this_very_moment - occurence).total_seconds() > 60:
+                    log.info('Executing missed occurence %s of schedule %s', occurence, schedule.name)
+                execute(apiserver, schedule)
+            with transaction.manager as txn:
+                schedule.last_occurence = occurence
+                txn.note('Executed occurence %s of schedule %s' % (occurence, schedule.name))
+            # After the commit, so that the timetable doesn't take the new serial for a change of the schedule.
+            timetable.plan(schedule, this_very_moment)
+    occurence = timetable.next_occurence()
+    if occurence:
+        apiserver.wakeup_in((occurence - now()).total_seconds())
 
 
 def execute(apiserver, schedule):
     log.debug('Executing schedule %s', schedule)
     for action in schedule.actions:
         action.execute(apiserver)
-
-
-def seconds_until_next_occurence():
-    this_very_moment = now()
-    next_sweep = this_very_moment + datetime.timedelta(days=10)
-    for si in ScheduleItem.objects.all():
-        occurence = si.recurrence.after(
-            this_very_moment, dtstart=si.recurrence_start, dtend=next_sweep,
-        )
-        if occurence and occurence < next_sweep:
-            next_sweep = occurence
-    delta_secs_into_the_future = int(max((next_sweep - now()).total_seconds(), 0))
-    return delta_secs_into_the_future
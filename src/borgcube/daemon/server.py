@@ -1,12 +1,19 @@
+import datetime
 import errno
+import json
 import logging
 import signal
+import socket
 import stat
 import sys
+import threading
 import time
 import os
+import queue
+from binascii import hexlify, unhexlify
 from urllib.parse import urlunsplit, urlsplit
-from collections import defaultdict
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import zmq
 
@@ -14,15 +21,86 @@ import zodburi
 import transaction
 
 from django.conf import settings
+from django.utils.timezone import now
 
 import borgcube
-from ..core.models import Job
+from ..core.models import Job, rusage_dict, RESOURCE_USAGE_FIELDS, RESOURCE_USAGE_ATTEMPTS
 from ..utils import set_process_name, hook, data_root, reset_db_connection, log_to_daemon
-from .utils import get_socket_addr
+from . import client as api_client
+from .jobqueue import JobQueue
+from .metrics import DaemonMetrics, MetricsRequestHandler
+from .utils import get_socket_addr, apply_resource_class, heartbeat, last_heartbeat, remove_heartbeat
 
 log = logging.getLogger('borgcubed')
 
 
+def pid_file(name):
+    """Return the path of the pid file *name* (of a worker or service that may outlive the daemon)."""
+    directory = get_socket_addr('pids')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return os.path.join(directory, name + '.pid')
+
+
+def write_pid_file(name, pid):
+    with open(pid_file(name), 'w') as fd:
+        fd.write('%d\n' % pid)
+
+
+def read_pid_file(name):
+    """Return the PID in the pid file *name*, or None."""
+    try:
+        with open(pid_file(name)) as fd:
+            return int(fd.read())
+    except (OSError, ValueError):
+        return None
+
+
+def remove_pid_file(name):
+    try:
+        os.unlink(pid_file(name))
+    except FileNotFoundError:
+        pass
+
+
+def write_agent_file(job_id, agent_name):
+    """Record that the job *job_id* runs on the worker agent *agent_name*."""
+    with open(pid_file('job-%d-agent' % job_id), 'w') as fd:
+        fd.write(agent_name)
+
+
+def read_agent_file(job_id):
+    try:
+        with open(pid_file('job-%d-agent' % job_id)) as fd:
+            return fd.read().strip()
+    except OSError:
+        return None
+
+
+def is_running_child(pid):
+    """Return whether *pid* is a running child process of ours."""
+    try:
+        return os.waitpid(pid, os.WNOHANG) == (0, 0)
+    except ChildProcessError:
+        return False
+
+
+def is_running_worker(pid):
+    """Return whether *pid* is a running borgcubed worker, which need not be a child of ours."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Not ours, thus not a worker
+        return False
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as fd:
+            return b'borgcube' in fd.read()
+    except OSError:
+        # No procfs, can't tell for sure.
+        return True
+
+
 def exit_by_exception():
     class SignalException(BaseException):
         pass
@@ -42,17 +120,67 @@ def exit_by_exception():
     signal.signal(signal.SIGTERM, signal_fork)
 
 
+def fork_logging_locked():
+    """
+    Fork (os.fork) while holding the locks of all log handlers.
+
+    The log sinks (see `LogSink`) handle records in their own threads. A child forked while one of them is
+    inside a handler would inherit the lock of that handler in the acquired state, with no thread to release
+    it, and hang on its first log message. The child creates new locks instead.
+    """
+    handlers = [ref() for ref in list(logging._handlerList)]
+    handlers = [handler for handler in handlers if handler]
+    for handler in handlers:
+        handler.acquire()
+    try:
+        pid = os.fork()
+    except OSError:
+        for handler in handlers:
+            handler.release()
+        raise
+    for handler in handlers:
+        if pid:
+            handler.release()
+        else:
+            handler.createLock()
+    return pid
+
+
 class BaseServer:
+    # idle() is called at least this often (seconds)
+    idle_interval = 1
+
+    # Commands handled right away in the main loop. They need to be cheap.
+    # All other requests are handled by a pool of *request_threads* threads.
+    inline_commands = ()
+    request_threads = 4
+
     def __init__(self, address, context=None):
         log.info('borgcubed %s starting', borgcube.__version__)
-        self.socket = (context or zmq.Context.instance()).socket(zmq.REP)
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.ROUTER)
         self.socket.bind(address)
         log.debug('bound to %s', address)
+        # Further sockets (see bind_restricted) -> the commands accepted on them
+        self.restricted_sockets = {}
+
+        self.request_pool = ThreadPoolExecutor(self.request_threads)
+        # (function, args) to be called by the main loop (see call_in_main_loop), mostly sending
+        # the replies of requests handled in the pool
+        self.replies = queue.Queue()
 
         self.shutdown = False
         signal.signal(signal.SIGTERM, self.signal_terminate)
         signal.signal(signal.SIGINT, self.signal_terminate)
 
+        # Signals (notably SIGCHLD) wake up the main loop through this pipe.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGCHLD, self.signal_child)
+        self.deadline = 0
+
         self.stats = defaultdict(int)
         self.up = time.monotonic()
 
@@ -65,19 +193,105 @@ class BaseServer:
         self.shutdown = True
         signal.signal(signum, signal.SIG_IGN)
 
+    def signal_child(self, signum, stack_frame):
+        # Only needed to wake up the main loop through the wakeup fd.
+        pass
+
+    def bind_restricted(self, address, commands):
+        """Bind another ROUTER socket to *address*, which only accepts *commands*. Return the socket."""
+        sock = self.context.socket(zmq.ROUTER)
+        sock.bind(address)
+        self.restricted_sockets[sock] = frozenset(commands)
+        log.debug('bound to %s (commands: %s)', address, ', '.join(sorted(commands)))
+        return sock
+
+    def wakeup_in(self, seconds):
+        """Make sure that `idle` is called in *seconds* (or earlier)."""
+        self.deadline = min(self.deadline, time.monotonic() + max(seconds, 0))
+
     def main_loop(self):
         log.info('Daemon reporting for duty.')
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        for sock in self.restricted_sockets:
+            poller.register(sock, zmq.POLLIN)
+        poller.register(self.wakeup_r, zmq.POLLIN)
         while not self.shutdown:
-            self.idle()
-            last_idle = time.perf_counter()
-            while time.perf_counter() < last_idle + 1:
-                if self.socket.poll(timeout=500):
-                    request = self.socket.recv_json()
-                    reply = self._handle_request(request)
-                    self.socket.send_json(reply)
+            timeout = max(self.deadline - time.monotonic(), 0)
+            events = dict(poller.poll(timeout * 1000))
+            if self.wakeup_r in events:
+                self._drain_wakeup_fd()
+                # A child exited (or another signal arrived), handle that right away.
+                self.deadline = 0
+            for sock in [self.socket] + list(self.restricted_sockets):
+                if sock in events:
+                    self._receive_request(sock)
+            self._send_replies()
+            if time.monotonic() >= self.deadline:
+                self.deadline = time.monotonic() + self.idle_interval
+                self.idle()
         self.close()
         log.info('Exorcism successful. Have a nice day.')
 
+    def _drain_wakeup_fd(self):
+        try:
+            while os.read(self.wakeup_r, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _receive_request(self, sock):
+        # Envelope is the identity of the client plus the empty delimiter of REQ sockets.
+        *envelope, payload = sock.recv_multipart()
+        self.stats['requests'] += 1
+        try:
+            request = json.loads(payload.decode())
+        except ValueError:
+            self._reply(sock, envelope, self.error('invalid request: not JSON.'))
+            return
+        accepted = self.restricted_sockets.get(sock)
+        if accepted is not None and (not isinstance(request, dict) or request.get('command') not in accepted):
+            self._reply(sock, envelope, self.error('invalid request: command not accepted on this endpoint.'))
+            return
+        if not isinstance(request, dict) or request.get('command') in self.inline_commands:
+            self._reply(sock, envelope, self._handle_request(request))
+            return
+        future = self.request_pool.submit(self._handle_request, request)
+        future.add_done_callback(lambda future: self._handled_in_pool(sock, envelope, future))
+
+    def _handled_in_pool(self, sock, envelope, future):
+        # Called in the pool thread; the socket may only be used by the main loop.
+        try:
+            reply = future.result()
+        except BaseException:
+            reply = {'success': False, 'message': 'Uncaught exception during processing'}
+        self.call_in_main_loop(self._reply, sock, envelope, reply)
+
+    def call_in_main_loop(self, function, *args):
+        """
+        Call *function* with *args* in the main loop, soon. Threads must use this for anything
+        touching the state of the daemon.
+        """
+        self.replies.put((function, args))
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            # Pipe is full, the main loop will wake up anyway.
+            pass
+
+    def _send_replies(self):
+        while True:
+            try:
+                function, args = self.replies.get_nowait()
+            except queue.Empty:
+                break
+            function(*args)
+
+    def _reply(self, sock, envelope, reply):
+        if not reply.get('success', True):
+            self.stats['failed_requests'] += 1
+        sock.send_multipart(envelope + [json.dumps(reply).encode()])
+
     def _handle_request(self, request):
         """Handle *request*, return reply."""
         if not isinstance(request, dict):
@@ -106,24 +320,34 @@ class BaseServer:
         pass
 
     def close(self):
+        self.request_pool.shutdown(wait=False)
         self.socket.close()
         self.socket = None
+        for sock in self.restricted_sockets:
+            sock.close()
+        self.restricted_sockets = {}
         signal.signal(signal.SIGINT, signal.SIG_DFL)
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self._close_wakeup_fd()
+
+    def _close_wakeup_fd(self):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
 
     def error(self, message, *parameters):
         """
         Log error *message* formatted (%) with *parameters*. Return response dictionary.
         """
         log.error('Request failed: ' + message, *parameters)
-        self.stats['failed_requests'] += 1
         return {
             'success': False,
             'message': message % parameters
         }
 
     def fork(self):
-        pid = os.fork()
+        pid = fork_logging_locked()
         if pid:
             log.debug('Forked worker PID is %d', pid)
             self.stats['forks'] += 1
@@ -131,10 +355,78 @@ class BaseServer:
             os.setpgrp()
             self.socket.close()
             self.socket = None
+            for sock in self.restricted_sockets:
+                sock.close()
+            self.restricted_sockets = {}
+            self._close_wakeup_fd()
             exit_by_exception()
         return pid
 
 
+def make_log_record(message):
+    """
+    Return a `logging.LogRecord` for the log *message* (dictionary) sent by `DaemonLogHandler`.
+
+    Raises KeyError for missing and ValueError/TypeError for erroneous parameters.
+    """
+    name = str(message['name'])
+    record = logging.LogRecord(**{
+        'name': name,
+        'pathname': str(message['path']),
+        'level': int(message['level']),
+        'lineno': int(message['lineno']),
+        'msg': '%s',
+        'args': (str(message['message']),),
+        'exc_info': None,
+    })
+    record.__dict__.update({
+        'function': str(message['function']),
+        'created': float(message['created']),
+        'asctime': str(message['asctime']),
+        'pid': int(message['pid']),
+    })
+    return record
+
+
+class LogSink(threading.Thread):
+    """
+    Thread receiving the log records shipped by workers and proxies (see `DaemonLogHandler`).
+
+    This keeps logging out of the main loop, so that chatty workers don't delay job dispatch.
+
+    If *tag* is given, messages are prefixed with it, so that records from untrusted senders (worker agents)
+    can't pass for records of the daemon.
+    """
+
+    def __init__(self, address, context=None, tag=None):
+        super().__init__(name='log-sink', daemon=True)
+        self.socket = (context or zmq.Context.instance()).socket(zmq.PULL)
+        self.socket.bind(address)
+        self.tag = tag
+        log.debug('log sink bound to %s', address)
+
+    def run(self):
+        while True:
+            try:
+                message = self.socket.recv_json()
+            except zmq.ContextTerminated:
+                break
+            except ValueError:
+                log.error('Log sink received invalid message')
+                continue
+            try:
+                record = make_log_record(message)
+            except KeyError as ke:
+                log.error('Log sink received message without %r', ke.args[0])
+                continue
+            except (ValueError, TypeError) as exc:
+                log.error('Log sink received message with erroneous parameter: %s', exc)
+                continue
+            if self.tag:
+                record.msg = '[' + self.tag + '] %s'
+            logging.getLogger(record.name).handle(record)
+
+
 class Service:
     def __init__(self, fork):
         self.fork = fork
@@ -148,6 +440,14 @@ class Service:
 
 class ZEOService(Service):
     def launch(self):
+        pid = read_pid_file('zeo')
+        if pid and is_running_child(pid):
+            # Still running from before a restart (see APIServer.reexec)
+            self.zeo_path = get_socket_addr('zeo')
+            settings.DB_URI = urlunsplit(('zeo', '', self.zeo_path, '', ''))
+            log.debug('Adopted built-in ZEO (PID %d)', pid)
+            return pid
+
         self.check()
 
         received = False
@@ -166,6 +466,7 @@ class ZEOService(Service):
                     sys.exit(1)
 
         settings.DB_URI = urlunsplit(('zeo', '', self.zeo_path, '', ''))
+        write_pid_file('zeo', pid)
         log.debug('Launched built-in ZEO')
         return pid
 
@@ -262,19 +563,114 @@ class WebService(Service):
                 sys.exit(0)
 
 
+class MetricsService(Service):
+    def launch(self):
+        pid = self.fork()
+        if pid:
+            return pid
+        else:
+            from http.server import HTTPServer
+            host, port = settings.METRICS_LISTEN.rsplit(':', maxsplit=1)
+
+            set_process_name('borgcubed [metrics process]')
+
+            log.info('Serving metrics on http://%s:%s/metrics', host, port)
+
+            httpd = HTTPServer((host, int(port)), MetricsRequestHandler)
+            try:
+                httpd.serve_forever()
+            finally:
+                sys.exit(0)
+
+
+class Agent:
+    """A worker agent (see `borgcube.daemon.agent.WorkerAgent`) as seen by the daemon."""
+
+    def __init__(self, name):
+        self.name = name
+        self.capacity = 0
+        # Names of the repositories the agent can reach, None for all of them
+        self.repositories = None
+        self.last_seen = time.monotonic()
+        # Job ID -> job running (or about to be started) on the agent
+        self.jobs = {}
+        # IDs of jobs to start, handed to the agent with the next poll
+        self.pending = []
+        # IDs of jobs handed to the agent, which it didn't report as running (or finished) yet
+        self.unconfirmed = set()
+        # IDs of jobs to cancel; handed to the agent with every poll until they are gone
+        self.cancelled = set()
+
+    @property
+    def free_capacity(self):
+        return self.capacity - len(self.jobs)
+
+    def can_run(self, job):
+        if self.free_capacity <= 0:
+            return False
+        return not job.repository or self.repositories is None or job.repository.name in self.repositories
+
+
 class APIServer(BaseServer):
+    # New jobs are announced by the job-created command, and everything else of interest wakes up the
+    # main loop as well, so there is no need for frequent idle calls.
+    idle_interval = 5
+    # Scan the database for new jobs this often (seconds), in case we missed an announcement.
+    job_scan_interval = 60
+    # Worker agents which didn't poll for this long (seconds) are considered lost, along with their jobs.
+    agent_timeout = 30
+    # Check for stalled jobs (see STALL_TIMEOUTS) this often (seconds).
+    stall_check_interval = 10
+    # Check jobs left in an intermediate state by their worker this often (once a second) before failing them.
+    settle_attempts = 10
+
     def __init__(self, address, context=None):
         super().__init__(address, context)
+        # Jobs created by this process (eg. by the scheduler) are queued without a request
+        api_client.job_created_callback = self.job_created
+        # Job ID -> number of attempts to find it in the database
+        self.new_jobs = {}
+        self.next_job_scan = 0
+        self.next_stall_check = 0
         # PID -> (command, params...)
         self.children = {}
+        # PID -> job of workers adopted from a previous daemon, which are not our children (see adopt_worker)
+        self.foreign_workers = {}
+        # Agent name -> Agent
+        self.agents = {}
+        # Set to restart (re-execute) the daemon, handing over running jobs.
+        self.restart = False
+        signal.signal(signal.SIGHUP, self.signal_restart)
         # PID -> service instance
         self.services = {}
-        self.queue = []
+        # PID -> socket of idle pool workers (see start_worker)
+        self.idle_workers = {}
+        self.queue = JobQueue()
+        # Number of running workers per concurrency limit key (see limits)
+        self.running = Counter()
+        # Job ID -> expected duration of queued jobs with a time window (see within_window)
+        self.expected_durations = {}
+        # Job ID -> queued jobs waiting for it to finish (see Job.predecessors)
+        self.dependents = defaultdict(list)
+        # Job ID -> number of checks of jobs whose worker exited, leaving them in an intermediate state (see settle_job)
+        self.unsettled_jobs = {}
+        self.metrics = DaemonMetrics()
+        self.log_sink = LogSink('ipc://' + get_socket_addr('daemon-log'), context)
+        self.log_sink.start()
+        self.agent_log_sink = None
+        if settings.AGENT_LISTEN:
+            # Agents only get their own endpoints, not the full API (or the log sink of local workers).
+            self.bind_restricted(settings.AGENT_LISTEN['api'], self.agent_commands)
+            self.agent_log_sink = LogSink(settings.AGENT_LISTEN['log'], context, tag='worker agent')
+            self.agent_log_sink.start()
+            log.info('Accepting worker agents on %s', settings.AGENT_LISTEN['api'])
         set_process_name('borgcubed [main process]')
         if settings.BUILTIN_ZEO:
             self.launch_service(ZEOService)
         if settings.BUILTIN_WEB:
             self.launch_service(WebService)
+        if settings.METRICS_LISTEN:
+            self.launch_service(MetricsService)
 
         hook.borgcubed_startup(apiserver=self)
         db = data_root()
@@ -285,20 +681,86 @@ class APIServer(BaseServer):
                 if state in Job.State.STABLE:
                     continue
                 for job in jobs.values():
+                    if job.state in job.State.STAGED:
+                        # Waiting for the next stage, no worker involved.
+                        self.queue_job(job)
+                        self.queue.activate(job)
+                        txn.note(' - Queuing staged job %s' % job.id)
+                        continue
+                    if self.adopt_worker(job):
+                        txn.note(' - Adopted running job %s' % job.id)
+                        continue
                     job.set_failure_cause('borgcubed-restart')
                     txn.note(' - Failing previously running job %s due to restart' % job.id)
             for job in db.jobs_by_state.get(Job.State.job_created, {}).values():
                 self.queue_job(job)
                 txn.note(' - Queuing job %s' % job.id)
 
-    def launch_service(self, service):
-        inst = service(self.fork)
+    def adopt_worker(self, job):
+        """
+        Adopt the worker of *job* if it is still running (after a restart). Return whether it was adopted.
+        """
+        agent_name = read_agent_file(job.id)
+        if agent_name:
+            # The agent will poll again (or time out).
+            agent = self.agents.setdefault(agent_name, Agent(agent_name))
+            agent.jobs[job.id] = job
+            log.info('Adopted job %s running on worker agent %s', job.id, agent_name)
+            if last_heartbeat(job.id) is None:
+                heartbeat(job.id)
+            self.queue.activate(job)
+            self.running.update(key for key, limit in self.limits(job))
+            return True
+        pid = read_pid_file('job-%d' % job.id)
+        if not pid:
+            return False
+        if is_running_child(pid):
+            self.children[pid] = job.executor.name, job
+        elif is_running_worker(pid):
+            # The previous daemon died; we can't reap this one, nor get its exit status.
+            self.foreign_workers[pid] = job
+        else:
+            remove_pid_file('job-%d' % job.id)
+            return False
+        log.info('Adopted worker %d of job %s', pid, job.id)
+        if last_heartbeat(job.id) is None:
+            heartbeat(job.id)
+        self.queue.activate(job)
+        self.running.update(key for key, limit in self.limits(job))
+        return True
+
+    def signal_restart(self, signum, stack_frame):
+        log.info('Received signal %d, restarting', signum)
+        self.restart = True
+        self.shutdown = True
+
+    def main_loop(self):
+        super().main_loop()
+        if self.restart:
+            self.reexec()
+
+    def reexec(self):
+        """
+        Replace this process with a new borgcubed, which adopts the running workers.
+
+        Since the PID stays the same, the workers remain children of the daemon.
+        """
+        log.info('Re-executing borgcubed, handing over %d running jobs',
+                 len(self.children) + len(self.foreign_workers))
+        logging.shutdown()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def launch_service(self, service, *args):
+        """
+        Launch an instance of *service* (a `Service` subclass, instantiated with *args*). Return the instance.
+        """
+        inst = service(self.fork, *args)
         pid = inst.launch()
         self.services[pid] = inst
+        return inst
 
     def handle_request(self, request):
         command = request['command']
-        self.stats['requests'] += 1
         if command in self.commands:
             return self.commands[command](self, request)
         return hook.borgcubed_handle_request(apiserver=self, request=request)
@@ -307,37 +769,204 @@ class APIServer(BaseServer):
         transaction.begin()
         hook.borgcubed_idle(apiserver=self)
         self.check_children()
+        self.check_foreign_workers()
+        self.check_agents()
+        self.check_stalled_jobs()
         self.queue_new_jobs()
         self.check_queue()
+        self.fill_worker_pool()
 
     def close(self):
         super().close()
+        if self.restart:
+            self.close_for_handover()
+            return
         log.debug('Killing children')
         for pid in self.children:
             os.killpg(pid, signal.SIGTERM)
+        for pid in self.foreign_workers:
+            os.killpg(pid, signal.SIGTERM)
         log.debug('Waiting for all children to die')
         while self.children:
-            self.check_children()
+            self.check_children(block=True)
+        log.debug('Stopping idle workers')
+        for sock in self.idle_workers.values():
+            sock.close()
+        while self.idle_workers:
+            self.check_children(block=True)
         log.debug('Killing services')
         for pid in self.services:
             os.killpg(pid, signal.SIGTERM)
         while self.services:
-            self.check_children()
+            self.check_children(block=True)
+
+    def close_for_handover(self):
+        """Stop everything except the workers (and the database), which are handed over to the new daemon."""
+        log.debug('Stopping idle workers and services')
+        for sock in self.idle_workers.values():
+            sock.close()
+        for pid, service in self.services.items():
+            if not isinstance(service, ZEOService):
+                os.killpg(pid, signal.SIGTERM)
+        while self.idle_workers or any(not isinstance(service, ZEOService) for service in self.services.values()):
+            self.check_children(block=True)
 
     def queue_job(self, job):
         """
         Enqueue *job* instance for execution.
         """
-        for executor_class, qjob in self.queue:
-            if qjob == job:
-                return
-        executor_class = job.executor
-        self.queue.append((executor_class, job))
-        log.debug('Enqueued job %s', job.id)
+        if self.queue.push(job.executor, job):
+            log.debug('Enqueued job %s', job.id)
+
+    def deactivate_job(self, job):
+        """
+        Note that *job* left the daemon (it finished, failed or was cancelled), removing it from the queue
+        and the active jobs.
+        """
+        self.expected_durations.pop(job.id, None)
+        self.unsettled_jobs.pop(job.id, None)
+        queued = self.queue.remove(job)
+        if self.queue.deactivate(job) or queued:
+            self.metrics.job_finished(job)
+        self.release_dependents(job.id)
+
+    def release_dependents(self, job_id):
+        """Re-evaluate the queued jobs waiting for job *job_id* to finish."""
+        for dependent in self.dependents.pop(job_id, ()):
+            log.debug('Job %s finished, releasing job %s', job_id, dependent.id)
+            self.queue.touch(dependent)
+
+    def job_created(self, job_id):
+        """Note that job *job_id* was created; it is queued on the next idle call."""
+        if threading.current_thread() is not threading.main_thread():
+            # Eg. created by a plugin handling a request in the pool.
+            self.call_in_main_loop(self.job_created, job_id)
+            return
+        self.new_jobs.setdefault(job_id, 0)
+        self.wakeup_in(0)
 
     def queue_new_jobs(self):
-        for job in data_root().jobs_by_state.get(Job.State.job_created, {}).values():
-            self.queue_job(job)
+        if time.monotonic() >= self.next_job_scan:
+            self.next_job_scan = time.monotonic() + self.job_scan_interval
+            for job in data_root().jobs_by_state.get(Job.State.job_created, {}).values():
+                self.queue_job(job)
+            # In case a predecessor finished without us noticing (eg. it was cancelled before it was queued).
+            for job_id in list(self.dependents):
+                job = data_root().jobs.get(job_id)
+                if not job or job.finished:
+                    self.release_dependents(job_id)
+        jobs = data_root().jobs
+        for job_id, attempts in list(self.new_jobs.items()):
+            try:
+                job = jobs[job_id]
+            except KeyError:
+                # The announcement can be faster than the invalidations of our database connection.
+                if attempts < 10:
+                    self.new_jobs[job_id] += 1
+                    self.wakeup_in(1)
+                else:
+                    log.warning('Announced job %s not found', job_id)
+                    del self.new_jobs[job_id]
+                continue
+            del self.new_jobs[job_id]
+            if job.state == job.State.job_created:
+                self.queue_job(job)
+
+    def cmd_job_created(self, request):
+        try:
+            job_id = int(request['job_id'])
+        except (ValueError, KeyError) as ke:
+            return self.error('Missing parameter %r', ke.args[0])
+        self.job_created(job_id)
+        return {'success': True}
+
+    def cmd_agent_poll(self, request):
+        try:
+            name = str(request['agent'])
+            capacity = int(request['capacity'])
+            repositories = request['repositories']
+            running = {int(job_id) for job_id in request['running']}
+            finished = [(int(report['job_id']), bool(report['failed']), dict(report['rusage']))
+                        for report in request['finished']]
+            # Job ID -> seconds since the last heartbeat on the agent
+            heartbeats = {int(job_id): float(age) for job_id, age in request.get('heartbeats', {}).items()}
+        except KeyError as ke:
+            return self.error('Missing parameter %r', ke.args[0])
+        except (ValueError, TypeError) as exc:
+            return self.error('Erroneous parameter: %s', exc)
+        agent = self.agents.get(name)
+        if not agent:
+            log.info('Worker agent %s connected (capacity %d)', name, capacity)
+            agent = self.agents[name] = Agent(name)
+        agent.capacity = capacity
+        agent.repositories = set(repositories) if repositories is not None else None
+        agent.last_seen = time.monotonic()
+        for job_id, age in heartbeats.items():
+            beat = last_heartbeat(job_id)
+            if job_id in agent.jobs and beat is not None and time.time() - age > beat:
+                heartbeat(job_id, at=time.time() - age)
+
+        transaction.begin()
+        for job_id, failed, rusage in finished:
+            job = agent.jobs.pop(job_id, None)
+            if not job:
+                continue
+            (log.error if failed else log.debug)('Job %s on worker agent %s finished', job_id, name)
+            self.stats['job_failures' if failed else 'job_successes'] += 1
+            self.account_resource_usage(job, {field: rusage.get(field, 0) for field in RESOURCE_USAGE_FIELDS})
+            self.worker_exited(job, failed)
+        self.check_agent_jobs(agent, running | {job_id for job_id, failed, rusage in finished})
+        reply = {
+            'success': True,
+            'jobs': agent.pending,
+            'cancel': sorted(agent.cancelled),
+        }
+        agent.unconfirmed.update(agent.pending)
+        agent.pending = []
+        # Freed capacity might allow dispatching more jobs.
+        self.wakeup_in(0)
+        return reply
+
+    def check_agent_jobs(self, agent, reported):
+        """
+        Compare the jobs of *agent* with the IDs of the jobs it *reported* as running or finished.
+
+        Jobs the agent doesn't know about are handed out again if the agent never received them
+        (the reply to a poll can get lost), unless they were cancelled meanwhile, and failed otherwise.
+        """
+        agent.unconfirmed -= reported
+        for job_id, job in list(agent.jobs.items()):
+            if job_id in reported or job_id in agent.pending:
+                continue
+            if job_id in agent.unconfirmed and job_id not in agent.cancelled:
+                log.warning('Worker agent %s did not receive job %s, handing it out again', agent.name, job_id)
+                agent.unconfirmed.discard(job_id)
+                agent.pending.append(job_id)
+                continue
+            log.error('Job %s vanished from worker agent %s', job_id, agent.name)
+            del agent.jobs[job_id]
+            if job.state not in job.State.STABLE:
+                job.set_failure_cause('agent-lost', agent=agent.name)
+            self.worker_exited(job, failed=True)
+        agent.cancelled &= set(agent.jobs)
+
+    def check_agents(self):
+        """Forget worker agents which didn't poll for a while; their jobs are failed."""
+        for name, agent in list(self.agents.items()):
+            if time.monotonic() - agent.last_seen < self.agent_timeout:
+                continue
+            log.error('Lost worker agent %s', name)
+            del self.agents[name]
+            for job in agent.jobs.values():
+                if job.state not in job.State.STABLE:
+                    job.set_failure_cause('agent-lost', agent=name)
+                self.worker_exited(job, failed=True)
+
+    def choose_agent(self, job):
+        """Return the worker agent with the most free capacity that can run *job*, or None."""
+        agents = [agent for agent in self.agents.values() if agent.can_run(job)]
+        if agents:
+            return max(agents, key=lambda agent: agent.free_capacity)
 
     def cmd_cancel_job(self, request):
         try:
@@ -351,54 +980,86 @@ class APIServer(BaseServer):
         log.info('Cancelling job %s', job_id)
         if job.state not in job.State.STABLE:
             job.force_state(job.State.cancelled)
-        # TODO update
-        for i, (ec, item_job) in enumerate(self.queue[:]):
-            if item_job == job:
-                del self.queue[i]
-                log.info('Cancelled queued job %s', job_id)
-                return {'success': True}
+        if job in self.queue:
+            self.deactivate_job(job)
+            log.info('Cancelled queued job %s', job_id)
+            return {'success': True}
+        if self.cancel_worker(job):
+            return {'success': True}
+        self.release_dependents(job.id)
+        return {'success': True, 'message': 'Job neither active nor queued'}
+
+    def cancel_worker(self, job):
+        """Terminate the worker running *job*. Return whether there was one."""
         for pid, (command, item_job) in self.children.items():
             if item_job == job:
-                os.kill(pid, signal.SIGTERM)
-                log.info('Cancelled job %s (worker pid was %d)', job_id, pid)
-                return {'success': True}
-        return {'success': True, 'message': 'Job neither active nor queued'}
+                os.killpg(pid, signal.SIGTERM)
+                log.info('Cancelled job %s (worker pid was %d)', job.id, pid)
+                return True
+        for pid, item_job in self.foreign_workers.items():
+            if item_job == job:
+                os.killpg(pid, signal.SIGTERM)
+                log.info('Cancelled job %s (adopted worker pid was %d)', job.id, pid)
+                return True
+        for agent in self.agents.values():
+            if job.id in agent.jobs:
+                agent.cancelled.add(job.id)
+                log.info('Cancelling job %s on worker agent %s', job.id, agent.name)
+                return True
+        return False
+
+    def running_jobs(self):
+        """Return the jobs running in workers (local, adopted and on worker agents)."""
+        jobs = [job for command, job in self.children.values()]
+        jobs.extend(self.foreign_workers.values())
+        for agent in self.agents.values():
+            jobs.extend(agent.jobs.values())
+        return jobs
+
+    def check_stalled_jobs(self):
+        """Cancel running jobs which didn't make progress for longer than their stall timeout."""
+        if not settings.STALL_TIMEOUTS or time.monotonic() < self.next_stall_check:
+            return
+        self.next_stall_check = time.monotonic() + self.stall_check_interval
+        current_time = time.time()
+        for job in self.running_jobs():
+            timeout = settings.STALL_TIMEOUTS.get(job.short_name)
+            beat = last_heartbeat(job.id)
+            if not timeout or beat is None or current_time - beat < timeout:
+                continue
+            log.error('Job %s made no progress for %d seconds, cancelling it', job.id, current_time - beat)
+            self.stats['stalled_jobs'] += 1
+            # Only cancel it once, even if the worker takes a while to exit.
+            remove_heartbeat(job.id)
+            if job.state not in job.State.STABLE:
+                job.set_failure_cause('stalled', state=job.state, timeout=timeout)
+            self.cancel_worker(job)
 
     def cmd_log(self, request):
+        # Log records are normally shipped to the LogSink; this is kept for synchronous senders.
         try:
-            name = str(request['name'])
-            level = int(request['level'])
-            path = str(request['path'])
-            lineno  = int(request['lineno'])
-            message = str(request['message'])
-            function = str(request['function'])
-            created = float(request['created'])
-            asctime = str(request['asctime'])
-            pid = int(request['pid'])
+            record = make_log_record(request)
         except KeyError as ke:
             return self.error('Missing parameter %r', ke.args[0])
         except (ValueError, TypeError) as exc:
             return self.error('Erroneous parameter: %s', exc)
-        record = logging.LogRecord(**{
-            'name': name,
-            'pathname': path,
-            'level': level,
-            'lineno': lineno,
-            'msg': '%s',
-            'args': (message,),
-            'exc_info': None,
-        })
-        record.__dict__.update({
-            'function': function,
-            'created': created,
-            'asctime': asctime,
-            'pid': pid,
-        })
-        logging.getLogger(name).handle(record)
+        logging.getLogger(record.name).handle(record)
+        return {
+            'success': True,
+        }
+
+    def cmd_metrics(self, request):
         return {
+            'metrics': self.metrics.families(self),
             'success': True,
         }
 
+    def cmd_restart(self, request):
+        log.info('Restart requested')
+        self.restart = True
+        self.shutdown = True
+        return {'success': True}
+
     def cmd_stats(self, request):
         stats = dict(self.stats)
         stats['uptime'] = self.uptime
@@ -408,15 +1069,28 @@ class APIServer(BaseServer):
         }
 
     commands = {
+        'agent-poll': cmd_agent_poll,
         'cancel-job': cmd_cancel_job,
+        'job-created': cmd_job_created,
         'log': cmd_log,
+        'metrics': cmd_metrics,
+        'restart': cmd_restart,
         'stats': cmd_stats,
     }
+    # These touch the state of the daemon, and are cheap. Requests handled by plugins are run in the pool.
+    inline_commands = frozenset(commands)
+    # The only commands accepted on the AGENT_LISTEN endpoint.
+    agent_commands = frozenset({'agent-poll'})
 
-    def check_children(self):
-        while self.children or self.services:
+    def check_children(self, block=False):
+        """
+        Reap exited children. If *block* is true, wait for at least one child to exit.
+        """
+        flags = 0 if block else os.WNOHANG
+        while self.children or self.services or self.idle_workers:
             try:
-                pid, waitres = os.waitpid(-1, os.WNOHANG)
+                pid, waitres, rusage = os.wait4(-1, flags)
+                flags = os.WNOHANG
             except OSError as oe:
                 if oe.errno == errno.ECHILD:
                     # Uh-oh
@@ -424,6 +1098,9 @@ class APIServer(BaseServer):
                     for pid, (command, job) in self.children.items():
                         log.error('I am missing child %d, command %s %s', pid, command, job.id)
                     self.children.clear()
+                    self.running.clear()
+                    self.idle_workers.clear()
+                    self.services.clear()
                     break
             if not pid:
                 break
@@ -439,50 +1116,303 @@ class APIServer(BaseServer):
                 logger('Child %d exited with code %d on signal %d', pid, code, signo)
             else:
                 logger('Child %d exited with code %d', pid, code)
+            if self.idle_workers.pop(pid, None):
+                logger('Child was an idle worker')
+                continue
             service = self.services.pop(pid, None)
             if service:
                 logger('Child was service process %s', service)
+                # Services may have changed what queued jobs are waiting for (e.g. client probes).
+                self.queue.touch_all()
+                continue
+            if pid not in self.children:
+                logger('Child was a discarded idle worker')
                 continue
             command, job = self.children.pop(pid)
             logger('Command was: %s %r', command, job.id)
-            if code or signo:
-                if job.state not in job.State.STABLE or job.state == job.State.job_created:
-                    job.force_state(job.State.failed)
+            self.account_resource_usage(job, rusage_dict(rusage))
+            self.worker_exited(job, failed=code or signo)
             hook.borgcubed_job_exit(apiserver=self, job=job, exit_code=code, signo=signo)
 
+    def check_foreign_workers(self):
+        """Check whether adopted workers which aren't our children (see adopt_worker) are still running."""
+        for pid, job in list(self.foreign_workers.items()):
+            if is_running_worker(pid):
+                continue
+            del self.foreign_workers[pid]
+            # Without an exit status the job state has to tell whether the worker succeeded.
+            failed = job.state not in job.State.STABLE and job.state not in job.State.STAGED
+            log.log(logging.ERROR if failed else logging.DEBUG, 'Adopted worker %d of job %s exited', pid, job.id)
+            self.worker_exited(job, failed)
+
+    def worker_exited(self, job, failed):
+        remove_pid_file('job-%d' % job.id)
+        remove_pid_file('job-%d-agent' % job.id)
+        remove_heartbeat(job.id)
+        self.running.subtract(key for key, limit in self.limits(job))
+        self.queue.release_throttled()
+        if failed:
+            if job.state not in job.State.STABLE or job.state == job.State.job_created:
+                job.force_state(job.State.failed)
+            self.deactivate_job(job)
+        elif job.finished:
+            self.deactivate_job(job)
+        else:
+            # Staged for its next stage, which check_queue dispatches. Otherwise we might not see the
+            # last state update of the worker yet, see settle_job.
+            if job.state not in job.State.STAGED:
+                self.unsettled_jobs[job.id] = 0
+            self.queue_job(job)
+            self.queue.touch(job)
+
+    def account_resource_usage(self, job, usage):
+        try:
+            # The totals of the repository and client are shared with other jobs finishing at the same time.
+            for attempt in transaction.manager.attempts(RESOURCE_USAGE_ATTEMPTS):
+                with attempt as txn:
+                    job.account_resource_usage('worker', usage)
+                    txn.note('Accounted resource usage of worker of job %s' % job.id)
+        except Exception:
+            log.exception('Could not store resource usage of job %s', job.id)
+
     def check_queue(self):
         if self.shutdown:
             self.queue.clear()
             return
-        queue = []
-        for executor_class, job in self.queue:
-            if not executor_class.can_run(job):
-                queue.append((executor_class, job))
-                continue
+        current_time = now()
+        candidates = []
+        for key in self.queue.pop_dirty(current_time):
+            candidates.extend(self.queue.run_queue(key))
+        # Stable sort, hence FIFO for equal priorities.
+        candidates.sort(key=lambda candidate: self.effective_priority(candidate[1], current_time), reverse=True)
+        for executor_class, job in candidates:
+            self.check_queued_job(executor_class, job)
+
+    @staticmethod
+    def effective_priority(job, current_time):
+        """Return the priority of queued *job*, including the bonus for the time it has been waiting."""
+        priority = job.priority
+        if settings.JOB_PRIORITY_AGING:
+            waiting = (current_time - (job.not_before or job.created)).total_seconds()
+            priority += max(waiting, 0) / settings.JOB_PRIORITY_AGING
+        return priority
+
+    def limits(self, job):
+        """
+        Return the concurrency limits applying to *job* as a list of (key, limit) tuples.
+
+        *limit* is None for no limit.
+        """
+        limits = [
+            ('all', settings.MAX_JOBS),
+            (('type', job.short_name), settings.MAX_JOBS_PER_TYPE.get(job.short_name)),
+        ]
+        if job.repository:
+            limits.append((('repository', job.repository._p_oid), settings.MAX_JOBS_PER_REPOSITORY))
+        client = getattr(job, 'client', None)
+        if client:
+            limits.append((('client', client._p_oid), settings.MAX_JOBS_PER_CLIENT))
+        return limits
+
+    def within_limits(self, job):
+        """Return whether another worker for *job* can be started without exceeding a concurrency limit."""
+        for key, limit in self.limits(job):
+            if limit is not None and self.running[key] >= limit:
+                log.debug('Job %s held back by concurrency limit %r (%d)', job.id, key, limit)
+                return False
+        return True
+
+    def check_queued_job(self, executor_class, job):
+        """Dispatch queued *job* if it can run now."""
+        if job.state in job.State.STABLE - {job.State.job_created}:
+            log.debug('Dropping job %s (%s) from queue', job.id, job.state)
+            self.deactivate_job(job)
+            return
+        if job.id in self.unsettled_jobs or (job.state != job.State.job_created and job.state not in job.State.STAGED):
+            if not self.settle_job(job):
+                return
+        waiting_for = job.waiting_for()
+        if waiting_for:
+            # Checked again when one of them finishes (see deactivate_job).
+            for predecessor in waiting_for:
+                if job not in self.dependents[predecessor.id]:
+                    self.dependents[predecessor.id].append(job)
+            return
+        if job.not_before and job.not_before > now():
+            self.wakeup_in((job.not_before - now()).total_seconds())
+            self.queue.touch_at(job, job.not_before)
+            return
+        # Later stages of a job already started in its window.
+        if job.window and job.state == job.State.job_created and not self.within_window(job):
+            return
+        if not self.within_limits(job):
+            self.queue.throttle(job)
+            return
+        if not executor_class.can_run(job, self.queue.active_jobs(job)):
+            return
 
+        try:
+            executor_class.prefork(job)
+        except Exception:
+            log.exception('Unhandled exception in %s.prefork(%s)', executor_class.__name__, job.id)
+            job.force_state(job.State.failed)
+            self.deactivate_job(job)
+            return
+        self.queue.remove(job)
+        self.queue.activate(job)
+        heartbeat(job.id)
+
+        agent = self.choose_agent(job)
+        if agent:
+            agent.jobs[job.id] = job
+            agent.pending.append(job.id)
+            write_agent_file(job.id, agent.name)
+            self.running.update(key for key, limit in self.limits(job))
+            log.debug('Dispatched job %s to worker agent %s', job.id, agent.name)
+            return
+
+        pid = self.start_worker(executor_class, job)
+        # Parent, gotta watch the kids
+        self.children[pid] = executor_class.name, job
+        write_pid_file('job-%d' % job.id, pid)
+        self.running.update(key for key, limit in self.limits(job))
+
+    def settle_job(self, job):
+        """
+        Check queued *job*, whose worker exited without leaving it staged or finished. Return whether it can proceed.
+
+        Usually the last state update of the worker just isn't visible yet, so the job is checked again
+        for a few seconds, before it is failed.
+        """
+        if job.state in job.State.STAGED:
+            del self.unsettled_jobs[job.id]
+            return True
+        attempts = self.unsettled_jobs.get(job.id, 0)
+        if attempts < self.settle_attempts:
+            self.unsettled_jobs[job.id] = attempts + 1
+            self.queue.touch(job)
+            self.wakeup_in(1)
+            return False
+        log.error('Worker of job %s exited leaving the job in state %s, failing it', job.id, job.state)
+        job.force_state(job.State.failed)
+        self.deactivate_job(job)
+        return False
+
+    def within_window(self, job):
+        """
+        Return whether *job* may start now in its time window, ie. the window is open and the job is expected
+        to finish before it closes. Otherwise the job is checked again when the next window opens.
+        """
+        current_time = now()
+        opens, closes = job.window.current(current_time)
+        if opens <= current_time:
+            if job.id not in self.expected_durations:
+                self.expected_durations[job.id] = job.expected_duration()
+            expected = self.expected_durations[job.id]
+            # Jobs that never fit into the window run whenever it is open.
+            if not expected or current_time + expected <= closes or expected >= job.window.length:
+                return True
+            log.debug('Holding job %s: expected to take %s, but its window %s closes at %s',
+                      job.id, expected, job.window, closes)
+            opens += datetime.timedelta(days=1)
+        self.queue.touch_at(job, opens)
+        self.wakeup_in((opens - current_time).total_seconds())
+        return False
+
+    def fork(self):
+        pid = super().fork()
+        if not pid:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            api_client.job_created_callback = None
+            # Only the main process talks to idle workers
+            for sock in self.idle_workers.values():
+                sock.close()
+            self.idle_workers.clear()
+        return pid
+
+    def start_worker(self, executor_class, job):
+        """
+        Start running *job* in a worker process. Return the PID of the worker.
+
+        An idle worker from the pool is used if possible, otherwise a new one is forked.
+        """
+        while self.idle_workers:
+            pid, sock = self.idle_workers.popitem()
             try:
-                executor_class.prefork(job)
-            except Exception:
-                log.exception('Unhandled exception in %s.prefork(%s)', executor_class.__name__, job.id)
-                job.force_state(job.State.failed)
-                continue
+                # The serial of the job tells the worker which state of the job it has to wait for (see run_job).
+                sock.sendall(b'%d %s\n' % (job.id, hexlify(job._p_serial)))
+                return pid
+            except OSError as exc:
+                log.warning('Idle worker %d is unusable (%s), discarding it', pid, exc)
+                os.kill(pid, signal.SIGTERM)
+            finally:
+                sock.close()
 
-            id = job.id
+        id = job.id
+        pid = self.fork()
+        if pid:
+            return pid
+        # One important thing to note about ZODB is that live objects are connected to their DB instance
+        # which is entangled with the async/client business. When forking we need to get rid of these FDs
+        # (can't use them from two processes at once), which also means we can't re-use objects across
+        # a fork.
+        # (Technically *job* was live and loaded, so we could use it here, but to make this more explicit
+        # we don't).
+        log_to_daemon()
+        reset_db_connection()
+        self.run_job(id)
+
+    def fill_worker_pool(self):
+        """Fork idle workers until there are WORKER_POOL_SIZE of them."""
+        while not self.shutdown and len(self.idle_workers) < settings.WORKER_POOL_SIZE:
+            parent_sock, child_sock = socket.socketpair()
             pid = self.fork()
             if pid:
-                # Parent, gotta watch the kids
-                self.children[pid] = executor_class.name, job
-            else:
-                # One important thing to note about ZODB is that live objects are connected to their DB instance
-                # which is entangled with the async/client business. When forking we need to get rid of these FDs
-                # (can't use them from two processes at once), which also means we can't re-use objects across
-                # a fork.
-                # (Technically *job* was live and loaded, so we could use it here, but to make this more explicit
-                # we don't).
-                log_to_daemon()
-                set_process_name('borgcubed [%s %s]' % (executor_class.name, id))
-                reset_db_connection()
-                job = data_root().jobs[id]
-                executor_class.run(job)
+                child_sock.close()
+                self.idle_workers[pid] = parent_sock
+                continue
+            parent_sock.close()
+            log_to_daemon()
+            set_process_name('borgcubed [idle worker]')
+            # Open the database (cf. start_worker) ahead of time, so that the job can start right away.
+            reset_db_connection()
+            data_root()
+            transaction.abort()
+            with child_sock.makefile('rb') as file:
+                line = file.readline()
+            child_sock.close()
+            if not line:
+                # The daemon is shutting down, or discarded us.
                 sys.exit(0)
-        self.queue = queue
+            id, serial = line.split()
+            self.run_job(int(id), unhexlify(serial))
+
+    # Seconds a worker waits for the state of its job handed over by the daemon to become visible.
+    worker_sync_timeout = 30
+
+    @classmethod
+    def run_job(cls, id, serial=None):
+        """
+        Run job *id* in this worker process and exit.
+
+        If *serial* is given, wait until the job is at least at this serial. Workers of the pool connected to
+        the database before the daemon updated the job (prefork), and the invalidations of a ZEO connection
+        arrive asynchronously, so the worker might not see the update right away.
+        """
+        deadline = time.monotonic() + cls.worker_sync_timeout
+        while True:
+            transaction.begin()
+            job = data_root().jobs.get(id)
+            if job is not None:
+                job._p_activate()
+                if serial is None or job._p_serial >= serial:
+                    break
+            if time.monotonic() > deadline:
+                log.error('Job %s did not reach serial %s in time, giving up', id, hexlify(serial).decode())
+                sys.exit(1)
+            time.sleep(0.1)
+        executor_class = job.executor
+        set_process_name('borgcubed [%s %s]' % (executor_class.name, id))
+        apply_resource_class(job.short_name)
+        executor_class.run(job)
+        sys.exit(0)
@@ -0,0 +1,473 @@
+import datetime
+import io
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+import zmq
+
+from django.utils import timezone
+
+from ..core.models import TimeWindow
+from ..job.backup import BackupJob
+from ..utils import DaemonLogHandler
+from .jobqueue import JobQueue
+from .metrics import Histogram, render_metrics
+from .scheduler import Timetable
+from .server import Agent, APIServer, fork_logging_locked, make_log_record
+from .utils import heartbeat, last_heartbeat, remove_heartbeat, apply_resource_class
+
+
+def make_job(id, repository=None):
+    return SimpleNamespace(id=id, repository=repository)
+
+
+repository1 = SimpleNamespace(_p_oid=b'1')
+repository2 = SimpleNamespace(_p_oid=b'2')
+
+
+class TestJobQueue:
+    def test_push(self):
+        queue = JobQueue()
+        job = make_job(1, repository1)
+        assert queue.push(None, job)
+        assert not queue.push(None, job)
+        assert job in queue
+        assert len(queue) == 1
+        assert list(queue) == [(None, job)]
+
+    def test_run_queues(self):
+        queue = JobQueue()
+        jobs = [make_job(1, repository1), make_job(2, repository2), make_job(3, repository1)]
+        for job in jobs:
+            queue.push(None, job)
+        assert sorted(queue.pop_dirty(0)) == [b'1', b'2']
+        assert queue.pop_dirty(0) == []
+        assert queue.run_queue(b'1') == [(None, jobs[0]), (None, jobs[2])]
+
+        assert queue.remove(jobs[1])
+        assert not queue.remove(jobs[1])
+        assert queue.run_queue(b'2') == []
+        assert list(queue) == [(None, jobs[0]), (None, jobs[2])]
+
+    def test_active(self):
+        queue = JobQueue()
+        running = make_job(1, repository1)
+        queued = make_job(2, repository1)
+        queue.push(None, queued)
+        queue.activate(running)
+        queue.pop_dirty(0)
+        assert queue.active_jobs(queued) == [running]
+        assert queue.active_jobs(running) == []
+        assert queue.active_jobs(make_job(3, repository2)) == []
+
+        queue.deactivate(running)
+        assert queue.active_jobs(queued) == []
+        assert queue.pop_dirty(0) == [b'1']
+
+    def test_deactivate_without_repository(self):
+        queue = JobQueue()
+        queue.push(None, make_job(1, repository1))
+        queue.push(None, make_job(2, repository2))
+        queue.pop_dirty(0)
+        prune = make_job(3)
+        queue.activate(prune)
+        queue.deactivate(prune)
+        assert sorted(queue.pop_dirty(0)) == [b'1', b'2']
+
+    def test_touch_at(self):
+        queue = JobQueue()
+        job = make_job(1, repository1)
+        queue.push(None, job)
+        queue.pop_dirty(0)
+        queue.touch_at(job, 10)
+        assert queue.pop_dirty(5) == []
+        assert queue.pop_dirty(10) == [b'1']
+        assert queue.pop_dirty(20) == []
+
+    def test_touch_at_earliest(self):
+        queue = JobQueue()
+        job = make_job(1, repository1)
+        queue.push(None, job)
+        queue.pop_dirty(0)
+        for i in range(10):
+            queue.touch_at(job, 10)
+            queue.touch_at(make_job(2, repository1), 20)
+        assert len(queue.timers) == 1
+        # An earlier timer replaces the later one.
+        queue.touch_at(job, 5)
+        assert queue.pop_dirty(5) == [b'1']
+        assert queue.pop_dirty(10) == []
+        queue.touch_at(job, 10)
+        assert queue.pop_dirty(10) == [b'1']
+
+    def test_throttle(self):
+        queue = JobQueue()
+        job = make_job(1, repository1)
+        queue.push(None, job)
+        queue.pop_dirty(0)
+        queue.throttle(job)
+        assert queue.pop_dirty(0) == []
+        queue.release_throttled()
+        assert queue.pop_dirty(0) == [b'1']
+
+
+def test_log_shipping():
+    context = zmq.Context()
+    sink = context.socket(zmq.PULL)
+    sink.bind('inproc://log-sink')
+    handler = DaemonLogHandler('inproc://log-sink', context=context)
+    record = logging.LogRecord('borgcube.test', logging.WARNING, 'path.py', 42, 'Hello %s', ('World',), None)
+    handler.handle(record)
+    message = sink.recv_json()
+    handler.close()
+    sink.close()
+    context.term()
+
+    shipped = make_log_record(message)
+    assert shipped.name == 'borgcube.test'
+    assert shipped.levelno == logging.WARNING
+    assert shipped.lineno == 42
+    assert shipped.getMessage() == 'Hello World'
+
+
+def test_fork_logging_locked():
+    # Another thread (like the log sink) is inside a handler while the process forks.
+    handler = logging.StreamHandler(io.StringIO())
+    logger = logging.getLogger('borgcube.test.fork')
+    logger.addHandler(handler)
+    handler.acquire()
+    forked = threading.Event()
+    thread = threading.Thread(target=lambda: (forked.set(), fork_status.append(fork_logging_locked())))
+    fork_status = []
+    try:
+        thread.start()
+        forked.wait()
+        # The fork waits for the handler.
+        thread.join(0.1)
+        assert thread.is_alive()
+    finally:
+        handler.release()
+    thread.join()
+    pid, = fork_status
+    if not pid:
+        # Child: the handler must not be locked.
+        logger.warning('hello from the child')
+        os._exit(0)
+    try:
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+    finally:
+        logger.removeHandler(handler)
+
+
+def test_make_log_record_missing():
+    with pytest.raises(KeyError):
+        make_log_record({'name': 'borgcube.test'})
+
+
+def test_render_metrics():
+    histogram = Histogram((10, 100))
+    histogram.observe(5)
+    histogram.observe(50)
+    families = [
+        {'name': 'borgcube_queued_jobs', 'type': 'gauge', 'help': 'Queued jobs',
+         'samples': [('borgcube_queued_jobs', {'repository': 'a "repo"'}, 3)]},
+        {'name': 'borgcube_job_duration_seconds', 'type': 'histogram', 'help': 'Duration',
+         'samples': list(histogram.samples('borgcube_job_duration_seconds', {'type': 'backup'}))},
+    ]
+    assert render_metrics(families).splitlines() == [
+        '# HELP borgcube_queued_jobs Queued jobs',
+        '# TYPE borgcube_queued_jobs gauge',
+        'borgcube_queued_jobs{repository="a \\"repo\\""} 3',
+        '# HELP borgcube_job_duration_seconds Duration',
+        '# TYPE borgcube_job_duration_seconds histogram',
+        'borgcube_job_duration_seconds_bucket{le="10",type="backup"} 1',
+        'borgcube_job_duration_seconds_bucket{le="100",type="backup"} 2',
+        'borgcube_job_duration_seconds_bucket{le="+Inf",type="backup"} 2',
+        'borgcube_job_duration_seconds_sum{type="backup"} 55',
+        'borgcube_job_duration_seconds_count{type="backup"} 2',
+    ]
+
+
+def test_heartbeat(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmpdir))
+    assert last_heartbeat(1) is None
+    heartbeat(1, at=1000)
+    assert last_heartbeat(1) == 1000
+    heartbeat(1)
+    assert last_heartbeat(1) > 1000
+    remove_heartbeat(1)
+    assert last_heartbeat(1) is None
+
+
+def test_apply_resource_class_failures(settings, monkeypatch, caplog):
+    settings.JOB_RESOURCE_CLASSES = {'backup': {'nice': -5, 'ionice': ('best-efort', 4)}}
+
+    def nice(increment):
+        raise PermissionError(1, 'Operation not permitted')
+    monkeypatch.setattr('os.nice', nice)
+    # Logged, but the worker carries on.
+    apply_resource_class('backup')
+    warnings = [record.getMessage() for record in caplog.records if record.levelno == logging.WARNING]
+    assert len(warnings) == 2
+    assert 'best-efort' in warnings[1]
+
+
+class FakeRecurrence:
+    def __init__(self, interval):
+        self.interval = interval
+        self.evaluations = 0
+
+    def after(self, moment):
+        self.evaluations += 1
+        return (moment // self.interval + 1) * self.interval
+
+
+def make_schedule(oid, interval):
+    recurrence = FakeRecurrence(interval)
+    return SimpleNamespace(_p_oid=oid, _p_serial=b'1', name=oid, recurrence_enabled=True, last_occurence=None,
+                           recurrence=recurrence, after=recurrence.after)
+
+
+def test_timetable():
+    timetable = Timetable()
+    hourly, daily = make_schedule('hourly', 60), make_schedule('daily', 24 * 60)
+    timetable.update([hourly, daily], 0)
+    timetable.update([hourly, daily], 30)
+    assert hourly.recurrence.evaluations == 1
+    assert timetable.next_occurence() == 60
+    assert timetable.pop_due(59) == []
+    assert timetable.pop_due(60) == [('hourly', 60)]
+    timetable.plan(hourly, 60)
+    assert timetable.next_occurence() == 120
+
+    # Changed schedules are re-planned, disabled ones dropped.
+    daily._p_serial = b'2'
+    daily.recurrence.interval = 90
+    hourly.recurrence_enabled = False
+    timetable.update([hourly, daily], 60)
+    assert timetable.next_occurence() == 90
+    assert timetable.pop_due(24 * 60) == [('daily', 90)]
+
+
+def test_timetable_catch_up():
+    hourly = make_schedule('hourly', 60)
+    hourly.last_occurence = 120
+    # borgcubed wasn't running from 150 to 400: the missed occurences are due once.
+    timetable = Timetable()
+    timetable.update([hourly], 400, earliest=0)
+    assert timetable.pop_due(400) == [('hourly', 180)]
+    timetable.plan(hourly, 400)
+    assert timetable.next_occurence() == 420
+
+    # Only as far back as *earliest*
+    timetable = Timetable()
+    timetable.update([hourly], 400, earliest=300)
+    assert timetable.pop_due(400) == [('hourly', 360)]
+
+    # Later changes of the schedule are planned from the present.
+    hourly._p_serial = b'2'
+    timetable.update([hourly], 400, earliest=0)
+    assert timetable.next_occurence() == 420
+
+
+def make_server(**attributes):
+    server = APIServer.__new__(APIServer)
+    server.queue = JobQueue()
+    server.deadline = math.inf
+    server.__dict__.update(attributes)
+    return server
+
+
+def local_time(hour, minute=0, day=1):
+    return timezone.make_aware(datetime.datetime(2026, 1, day, hour, minute))
+
+
+def make_window_job(id, window, expected_duration=None):
+    job = make_job(id, repository1)
+    job.window = window
+    job.expected_duration = lambda: expected_duration
+    return job
+
+
+def test_within_window_across_midnight(monkeypatch):
+    server = make_server(expected_durations={})
+    job = make_window_job(1, TimeWindow(datetime.time(22), datetime.time(6)), datetime.timedelta(hours=1))
+    server.queue.push(None, job)
+    server.queue.pop_dirty(local_time(0))
+
+    for moment in local_time(22), local_time(23, 30), local_time(2, day=2), local_time(4, 59, day=2):
+        monkeypatch.setattr('borgcube.daemon.server.now', lambda: moment)
+        assert server.within_window(job)
+    assert not server.queue.timers
+
+    # Too late to finish before 06:00, the job waits for the window to open again at 22:00.
+    monkeypatch.setattr('borgcube.daemon.server.now', lambda: local_time(5, 30, day=2))
+    assert not server.within_window(job)
+    monkeypatch.setattr('borgcube.daemon.server.now', lambda: local_time(12, day=2))
+    assert not server.within_window(job)
+    assert len(server.queue.timers) == 1
+    assert server.queue.pop_dirty(local_time(21, 59, day=2)) == []
+    assert server.queue.pop_dirty(local_time(22, day=2)) == [b'1']
+
+
+def test_within_window_expected_duration(monkeypatch):
+    window = TimeWindow(datetime.time(1), datetime.time(3))
+    monkeypatch.setattr('borgcube.daemon.server.now', lambda: local_time(2))
+
+    # Doesn't fit into the rest of the window: held until the next day, once.
+    server = make_server(expected_durations={})
+    job = make_window_job(1, window, datetime.timedelta(hours=1, minutes=30))
+    assert not server.within_window(job)
+    assert not server.within_window(job)
+    assert server.queue.timers == [(local_time(1, day=2), 0, b'1')]
+    assert server.deadline < math.inf
+
+    # Fits
+    server = make_server(expected_durations={})
+    assert server.within_window(make_window_job(1, window, datetime.timedelta(minutes=30)))
+
+    # Never fits into the window, hence runs whenever it is open
+    server = make_server(expected_durations={})
+    assert server.within_window(make_window_job(1, window, datetime.timedelta(hours=3)))
+
+    # Unknown duration
+    server = make_server(expected_durations={})
+    assert server.within_window(make_window_job(1, window))
+
+
+def make_backup_job(id, state, repository=repository1, client=b'client'):
+    job = make_job(id, repository)
+    job.__dict__.update(state=state, State=BackupJob.State, executor=None, short_name='backup', finished=False,
+                        client=SimpleNamespace(_p_oid=client))
+    job.force_state = lambda state: setattr(job, 'state', state)
+    return job
+
+
+@pytest.fixture
+def exiting_server(monkeypatch):
+    monkeypatch.setattr('borgcube.daemon.server.remove_pid_file', lambda name: None)
+    monkeypatch.setattr('borgcube.daemon.server.remove_heartbeat', lambda job_id: None)
+    return make_server(running=Counter(), unsettled_jobs={}, expected_durations={}, dependents=defaultdict(list),
+                       metrics=SimpleNamespace(job_finished=lambda job: None))
+
+
+def test_worker_exited_staged(exiting_server):
+    server = exiting_server
+    job = make_backup_job(1, BackupJob.State.client_staged)
+    server.running.update(key for key, limit in server.limits(job))
+    server.worker_exited(job, failed=False)
+    # Queued again for its second stage right away
+    assert job in server.queue
+    assert server.queue.pop_dirty(0) == [b'1']
+    assert job.id not in server.unsettled_jobs
+    assert not +server.running
+
+    # A worker exiting while the job isn't staged yet waits for the last state update of the job.
+    job = make_backup_job(2, BackupJob.State.client_preparing)
+    server.worker_exited(job, failed=False)
+    assert job in server.queue
+    assert job.id in server.unsettled_jobs
+
+
+def test_worker_exited_staged_failed(exiting_server):
+    job = make_backup_job(1, BackupJob.State.client_staged)
+    exiting_server.queue.push(None, job)
+    exiting_server.worker_exited(job, failed=True)
+    assert job.state == BackupJob.State.failed
+    assert job not in exiting_server.queue
+
+
+def test_concurrency_limits(settings):
+    settings.MAX_JOBS = 3
+    settings.MAX_JOBS_PER_CLIENT = 1
+    settings.MAX_JOBS_PER_REPOSITORY = None
+    settings.MAX_JOBS_PER_TYPE = {}
+    server = make_server(running=Counter())
+
+    def start(job):
+        assert server.within_limits(job)
+        server.running.update(key for key, limit in server.limits(job))
+
+    created = BackupJob.State.job_created
+    start(make_backup_job(1, created, repository1, b'client1'))
+    # One job per client, on any repository
+    assert not server.within_limits(make_backup_job(2, created, repository2, b'client1'))
+    start(make_backup_job(3, created, repository1, b'client2'))
+    start(make_backup_job(4, created, repository2, b'client3'))
+    # At most three jobs overall
+    assert not server.within_limits(make_backup_job(5, created, repository2, b'client4'))
+
+    settings.MAX_JOBS = None
+    assert server.within_limits(make_backup_job(5, created, repository2, b'client4'))
+    settings.MAX_JOBS_PER_TYPE = {'backup': 3}
+    assert not server.within_limits(make_backup_job(5, created, repository2, b'client4'))
+
+
+def test_priority_aging(settings, monkeypatch):
+    settings.JOB_PRIORITY_AGING = 600
+    current_time = local_time(12)
+    monkeypatch.setattr('borgcube.daemon.server.now', lambda: current_time)
+    server = make_server(shutdown=False)
+    dispatched = []
+    server.check_queued_job = lambda executor_class, job: dispatched.append(job.id)
+
+    def queue(id, priority, waiting):
+        job = make_job(id, repository1)
+        job.priority = priority
+        job.created = current_time - datetime.timedelta(minutes=waiting)
+        job.not_before = None
+        server.queue.push(None, job)
+        return job
+
+    # Waiting for more than two hours (12 levels) outweighs the priority of new jobs
+    queue(1, 0, waiting=130)
+    queue(2, 10, waiting=5)
+    queue(3, 10, waiting=0)
+    queue(4, 0, waiting=60)
+    server.check_queue()
+    assert dispatched == [1, 2, 3, 4]
+
+    # Without aging priority is absolute; FIFO within the same priority
+    settings.JOB_PRIORITY_AGING = None
+    dispatched.clear()
+    server.queue.touch_all()
+    server.check_queue()
+    assert dispatched == [2, 3, 1, 4]
+
+    # Waiting counts from not_before
+    settings.JOB_PRIORITY_AGING = 600
+    dispatched.clear()
+    server.queue.queued[1][1].not_before = current_time
+    server.queue.touch_all()
+    server.check_queue()
+    assert dispatched == [2, 3, 4, 1]
+
+
+def test_agent_timeout(exiting_server):
+    server = exiting_server
+    server.agents = {}
+    failure_causes = {}
+
+    def run_on(agent_name, job):
+        job.set_failure_cause = lambda cause, **kwargs: failure_causes.setdefault(job.id, (cause, kwargs))
+        agent = server.agents.setdefault(agent_name, Agent(agent_name))
+        agent.jobs[job.id] = job
+        server.queue.activate(job)
+
+    lost_job = make_backup_job(1, BackupJob.State.client_in_progress)
+    run_on('lost', lost_job)
+    run_on('alive', make_backup_job(2, BackupJob.State.client_in_progress))
+    server.agents['lost'].last_seen = time.monotonic() - server.agent_timeout - 1
+    server.check_agents()
+    assert list(server.agents) == ['alive']
+    assert lost_job.state == BackupJob.State.failed
+    assert failure_causes == {1: ('agent-lost', {'agent': 'lost'})}
+    assert server.agents['alive'].jobs
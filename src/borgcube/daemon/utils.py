@@ -1,4 +1,6 @@
+import logging
 import os
+import subprocess
 import tempfile
 import textwrap
 import threading
@@ -9,6 +11,8 @@ from borg.helpers import Error
 
 from django.conf import settings
 
+log = logging.getLogger(__name__)
+
 
 class ThreadPoolWSGIServer(WSGIServer):
     """
@@ -116,3 +120,96 @@ def get_socket_addr(suffix):
         except OSError as ose:
             raise NoSocketDir(ose, os.geteuid())
     return os.path.join(dir, 'borgcube-' + suffix)
+
+
+def heartbeat_file(job_id):
+    directory = get_socket_addr('heartbeats')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return os.path.join(directory, 'job-%d' % job_id)
+
+
+def heartbeat(job_id, at=None):
+    """
+    Record that the job *job_id* is making progress (see STALL_TIMEOUTS), now or *at* (as in time.time()).
+
+    The heartbeat is the modification time of a file, so any process of the job can cheaply signal it.
+    """
+    times = (at, at) if at else None
+    try:
+        path = heartbeat_file(job_id)
+        try:
+            os.utime(path, times)
+        except FileNotFoundError:
+            open(path, 'a').close()
+            os.utime(path, times)
+    except (OSError, NoSocketDir) as exc:
+        log.debug('Could not record heartbeat of job %s: %s', job_id, exc)
+
+
+def last_heartbeat(job_id):
+    """Return the time (as in time.time()) of the last heartbeat of job *job_id*, or None."""
+    try:
+        return os.stat(heartbeat_file(job_id)).st_mtime
+    except (OSError, NoSocketDir):
+        return None
+
+
+def remove_heartbeat(job_id):
+    try:
+        os.unlink(heartbeat_file(job_id))
+    except (OSError, NoSocketDir):
+        pass
+
+
+IONICE_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+
+
+def apply_resource_class(job_type):
+    """
+    Apply the resource class of *job_type* (see JOB_RESOURCE_CLASSES) to this process.
+
+    Problems are logged, but not fatal: the job should still run.
+    """
+    resource_class = settings.JOB_RESOURCE_CLASSES.get(job_type)
+    if not resource_class:
+        return
+    cgroup = resource_class.get('cgroup')
+    if cgroup:
+        try:
+            os.makedirs(cgroup, exist_ok=True)
+            for weight in ('cpu', 'io'):
+                value = resource_class.get(weight + '_weight')
+                if value is not None:
+                    with open(os.path.join(cgroup, weight + '.weight'), 'w') as fd:
+                        fd.write('%d\n' % value)
+            with open(os.path.join(cgroup, 'cgroup.procs'), 'w') as fd:
+                fd.write('%d\n' % os.getpid())
+        except OSError as exc:
+            log.warning('Could not move worker into cgroup %s: %s', cgroup, exc)
+    if resource_class.get('nice'):
+        try:
+            os.nice(resource_class['nice'])
+        except OSError as exc:
+            # Eg. a negative increment without privileges
+            log.warning('Could not set niceness of worker: %s', exc)
+    ionice = resource_class.get('ionice')
+    if ionice:
+        try:
+            io_class, level = ionice
+            command = ['ionice', '-c', str(IONICE_CLASSES[io_class]), '-p', str(os.getpid())]
+        except KeyError as ke:
+            log.warning('Unknown I/O scheduling class %r in the resource class of %s jobs', ke.args[0], job_type)
+        except (ValueError, TypeError):
+            log.warning('Invalid ionice setting %r in the resource class of %s jobs', ionice, job_type)
+        else:
+            if level is not None:
+                command[3:3] = ['-n', str(level)]
+            try:
+                subprocess.check_call(command)
+            except (OSError, subprocess.CalledProcessError) as exc:
+                log.warning('Could not set I/O scheduling class of worker: %s', exc)
+    log.debug('Applied resource class of %s jobs: %r', job_type, resource_class)
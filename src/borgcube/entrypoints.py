@@ -72,9 +72,19 @@ def errhandler(func):
 
 @errhandler
 def daemon():
+    import argparse
     from .daemon.server import APIServer
     from .daemon.utils import get_socket_addr
     from .utils import hook
+    parser = argparse.ArgumentParser(prog='borgcubed', description='BorgCube daemon')
+    parser.add_argument('--worker', action='store_true',
+                        help='run as a worker agent of the borgcubed at AGENT_CONNECT')
+    args = parser.parse_args()
+    if args.worker:
+        from .daemon.agent import WorkerAgent
+        hook.borgcube_startup(process='borgcubed-worker')
+        WorkerAgent().main_loop()
+        return
     hook.borgcube_startup(process='borgcubed')
     server = APIServer('ipc://' + get_socket_addr('daemon'))
     server.main_loop()
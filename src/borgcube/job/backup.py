@@ -1,17 +1,24 @@
 import configparser
 import collections
+import datetime
 import logging
 import hmac
+import itertools
 import re
 import shlex
 import shutil
 import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from hashlib import sha224
 from pathlib import Path
 from subprocess import CalledProcessError
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from django import forms
 
@@ -24,9 +31,15 @@ from borg.key import PlaintextKey
 from borg.repository import Repository
 from borg.locking import LockTimeout, LockFailed, LockError, LockErrorT
 
-from borgcube.core.models import Evolvable, ScheduledAction, Job, JobExecutor, s
+from borgcube.core.models import Evolvable, ScheduledAction, Job, JobExecutor, NumberTree, s, time_window
+from borgcube.core.models import active_jobs_of
+from borgcube.daemon.server import Service
+from borgcube.daemon.utils import get_socket_addr
 from borgcube.keymgt import synthesize_client_key, SyntheticManifest
+from borgcube.job.check import CheckConfig
+from borgcube.job.prune import PruneConfig, prune_root
 from borgcube.utils import open_repository, tee_job_logs, data_root, validate_regex, oid_bytes
+from borgcube.utils import set_process_name, reset_db_connection, log_to_daemon
 
 log = logging.getLogger(__name__)
 
@@ -37,16 +50,21 @@ def check_call(*popenargs, **kwargs):
 
 
 def queue_backup_job_conditional(apiserver, job_config):
-    for state, jobs in data_root().jobs_by_state.items():
-        if state in BackupJob.State.STABLE - {BackupJob.State.job_created}:
-            continue
-        for job in jobs.values():
-            if job.config == job_config:
-                log.warning(
-                    'run_from_schedule: not triggering a new job for config %s, since job %s is queued or running',
-                    job_config.oid, job.id)
-                return
-    job_config.create_job()
+    jobs = active_jobs_of(job_config)
+    if jobs:
+        log.warning(
+            'run_from_schedule: not triggering a new job for config %s, since job(s) %s are queued or running',
+            job_config.oid, ', '.join(str(job.id) for job in jobs))
+        return
+    return job_config.create_job()
+
+
+def cache_version(cache_path):
+    """Return the version (manifest ID) of the Borg cache at *cache_path*, or None if there is no cache."""
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(str(cache_path / 'config')):
+        return
+    return config.get('cache', 'manifest', fallback=None)
 
 
 def cpe_means_connection_failure(called_process_error):
@@ -58,6 +76,16 @@ def cpe_means_connection_failure(called_process_error):
             ('rsync' in command and exit_code in rsync_errors))
 
 
+# Failure causes which are likely transient; these are retried according to the retry policy of the BackupConfig.
+RETRY_FAILURE_CAUSES = {'client-connection-failed', 'repository-lock-timeout', 'cache-lock-timeout'}
+
+
+def borgcube_job_failure_cause(job, kind):
+    if isinstance(job, BackupJob) and kind in RETRY_FAILURE_CAUSES:
+        if job.config.retry(job):
+            transaction.commit()
+
+
 class RepositoryIDMismatch(RuntimeError):
     pass
 
@@ -65,9 +93,30 @@ class RepositoryIDMismatch(RuntimeError):
 class BackupJobExecutor(JobExecutor):
     name = 'backup-job'
 
+    # Whether to wait for the ClientProbeService before running a job
+    client_probe = True
+
+    @classmethod
+    def conflicts(cls, job, other_job):
+        if getattr(other_job, 'client', None) == job.client and other_job.state not in other_job.State.STAGED:
+            # Both jobs would use the same cache directory on the client
+            return True
+        return super().conflicts(job, other_job)
+
+    @classmethod
+    def can_run(cls, job, active_jobs=None):
+        if (cls.client_probe and settings.CLIENT_PROBE_TIMEOUT and
+                job.state == BackupJob.State.job_created and not job.client_borg_version):
+            log.debug('Job %s waits for the client probe', job.id)
+            return False
+        return super().can_run(job, active_jobs)
+
     @classmethod
     def prefork(cls, job):
-        job.update_state(BackupJob.State.job_created, BackupJob.State.client_preparing)
+        if job.state == BackupJob.State.client_staged:
+            job.update_state(BackupJob.State.client_staged, BackupJob.State.client_syncing)
+        else:
+            job.update_state(BackupJob.State.job_created, BackupJob.State.client_preparing)
 
     @classmethod
     def run(cls, job):
@@ -83,20 +132,19 @@ class BackupJobExecutor(JobExecutor):
         self.remote_cache_dir = self.find_remote_cache_dir()
         log.debug('remote_cache_dir is %r', self.remote_cache_dir)
         self.remote_security_dir = self.find_remote_cache_dir(suffix='faux-security')
+        self.remote_repository_cache_dir = self.remote_cache_dir + self.repository.repository_id + '/'
+        self.control_path = get_socket_addr('ssh-%s' % job.id)
+        self.rsh = self.client.connection.rsh_command(control_path=self.control_path)
         self.cache_path = Path(get_cache_dir()) / self.repository.repository_id
         log.debug('local cache is %s', self.cache_path)
 
     def execute(self):
         try:
-            self.synthesize_crypto(self.job)
-            job_cache_path = self.create_job_cache(self.cache_path)
-            self.transfer_cache(job_cache_path)
-            self.job.update_state(BackupJob.State.client_preparing, BackupJob.State.client_prepared)
-
-            self.remote_create(self.create_command_line())
-            self.client_cleanup()
-            self.job.update_state(BackupJob.State.client_cleanup, BackupJob.State.done)
-            log.info('Job %s completed successfully', self.job.id)
+            with self.master_connection():
+                if self.job.state == BackupJob.State.client_preparing:
+                    self.prepare_client()
+                else:
+                    self.backup()
         except CalledProcessError as cpe:
             self.job.force_state(BackupJob.State.failed)
             if not self.analyse_job_process_error(cpe):
@@ -135,6 +183,56 @@ class BackupJobExecutor(JobExecutor):
             self.job.set_failure_cause('repository-id-mismatch', repository_id=repo, saved_id=db)
             log.error('Job %s failed because the stored repository ID (%s) doesn\'t match the real repository ID (%s)', self.job, repo, db)
 
+    @contextmanager
+    def master_connection(self):
+        """
+        Establish a master connection to the client, which is re-used by all commands run
+        through `rsh_call` and `rsync_call`, as well as borg-create.
+
+        Only OpenSSH supports this; with other RSHs every command connects on its own.
+        """
+        connection = self.client.connection
+        if not connection.is_openssh:
+            yield
+            return
+        log.debug('Establishing master connection to %s (control path %s)', connection.remote, self.control_path)
+        check_call(self.rsh + ['-M', '-N', '-f', connection.remote])
+        try:
+            yield
+        finally:
+            log.debug('Closing master connection to %s', connection.remote)
+            subprocess.call(self.rsh + ['-O', 'exit', connection.remote],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def rsh_call(self, *command):
+        check_call(self.rsh + [self.client.connection.remote] + list(command))
+
+    def rsync_call(self, *args):
+        rsh = ' '.join(shlex.quote(arg) for arg in self.rsh)
+        check_call(('rsync', '-e', rsh) + args)
+
+    def prepare_client(self):
+        """
+        Pre-seed the cache on the client with the current chunks cache.
+
+        This doesn't need the repository, so it can run while other jobs use the repository,
+        and `transfer_cache` will only have to send a delta later on.
+        """
+        self.stage_cache()
+        self.job.update_state(BackupJob.State.client_preparing, BackupJob.State.client_staged)
+        log.info('Job %s staged, waiting for repository', self.job.id)
+
+    def backup(self):
+        self.synthesize_crypto(self.job)
+        job_cache_path = self.create_job_cache(self.cache_path)
+        self.transfer_cache(job_cache_path)
+        self.job.update_state(BackupJob.State.client_syncing, BackupJob.State.client_prepared)
+
+        self.remote_create(self.create_command_line())
+        self.client_cleanup()
+        self.job.update_state(BackupJob.State.client_cleanup, BackupJob.State.done)
+        log.info('Job %s completed successfully', self.job.id)
+
     def analyse_job_process_error(self, called_process_error):
         log.error('%s', called_process_error.stderr)
         log.error('%s', called_process_error.output)
@@ -165,23 +263,50 @@ class BackupJobExecutor(JobExecutor):
             transaction.get().note('Synthesized crypto for job %s' % job.id)
             transaction.commit()
 
+    def stage_cache(self, bwlimit=None):
+        chunks_cache = self.cache_path / 'chunks'
+        version = cache_version(self.cache_path)
+        if not version or not chunks_cache.is_file():
+            log.debug('stage_cache: no chunks cache yet, nothing to stage')
+            return
+        if self.client.staged_caches.get(self.repository.repository_id) == version:
+            log.debug('stage_cache: cache version %s is already staged on the client', version)
+            return
+        remote_dir = self.remote_repository_cache_dir
+        connstr = self.client.connection.remote + ':' + remote_dir
+        rsync = ('-r',)
+        if bwlimit:
+            rsync += '--bwlimit', str(bwlimit)
+        log.debug('stage_cache: chunks cache (version %s)', version)
+        self.rsh_call('mkdir', '-p', remote_dir)
+        # The cache is replaced atomically on commit, so this always sends a consistent (albeit maybe outdated) file.
+        self.rsync_call(*rsync + (str(chunks_cache), connstr))
+        self.set_staged_cache_version(version)
+        log.debug('stage_cache: done')
+
+    def set_staged_cache_version(self, version):
+        with transaction.manager as txn:
+            self.client.staged_caches[self.repository.repository_id] = version
+            txn.note('Staged cache %s of repository %s on client %s' % (version, self.repository.name, self.client.hostname))
+
     def transfer_cache(self, job_cache_path):
         # TODO per-client files cache, on the client or on the server?
-        # TODO rsh, rsh_options
-        remote_dir = self.remote_cache_dir + self.repository.repository_id + '/'
+        remote_dir = self.remote_repository_cache_dir
         connstr = self.client.connection.remote + ':' + remote_dir
-        rsync = ('rsync', '-rI', '--delete', '--exclude', '/files')
+        rsync = ('-rI', '--delete', '--exclude', '/files')
         log.debug('transfer_cache: rsync connection string is %r', connstr)
         log.debug('transfer_cache: auxiliary files')
         try:
-            check_call(('ssh', self.client.connection.remote, 'mkdir', '-p', remote_dir))
-            check_call(rsync + (str(job_cache_path) + '/', connstr))
+            self.rsh_call('mkdir', '-p', remote_dir)
+            # Keep the chunks cache staged on the client (prepare_client, CacheStagingJob), so that only a delta is sent.
+            self.rsync_call(*rsync + ('--exclude', '/chunks', str(job_cache_path) + '/', connstr))
         finally:
             shutil.rmtree(str(job_cache_path))
         log.debug('transfer_cache: chunks cache')
         chunks_cache = self.cache_path / 'chunks'
-        check_call(rsync + (str(chunks_cache), connstr))
-        check_call(('ssh', self.client.connection.remote, 'touch', remote_dir + 'files'))
+        self.rsync_call(*rsync + (str(chunks_cache), connstr))
+        self.rsh_call('touch', remote_dir + 'files')
+        self.set_staged_cache_version(cache_version(self.cache_path))
         log.debug('transfer_cache: done')
 
     def create_job_cache(self, cache_path):
@@ -237,11 +362,7 @@ class BackupJobExecutor(JobExecutor):
     def create_command_line(self):
         connection = self.client.connection
 
-        command_line = [connection.rsh]
-        if connection.ssh_identity_file:
-            command_line += '-i', connection.ssh_identity_file
-        if connection.rsh_options:
-            command_line.append(connection.rsh_options)
+        command_line = list(self.rsh)
         command_line.append(connection.remote)
         command_line.append('BORG_CACHE_DIR=' + self.remote_cache_dir)
         command_line.append('BORG_SECURITY_DIR=' + self.remote_security_dir)
@@ -339,10 +460,23 @@ class BackupJobExecutor(JobExecutor):
 class BackupJob(Job):
     short_name = 'backup'
     executor = BackupJobExecutor
+    priority = 10
+
+    # Set by the ClientProbeService
+    client_borg_version = None
+
+    # Retry lineage: number of the attempt, the job this one is retrying and the job retrying this one
+    attempt = 1
+    retry_of = None
+    retried_by = None
 
     class State(Job.State):
-        # Cache is uploaded to client
+        # Chunks cache is pre-seeded on the client, doesn't need the repository
         client_preparing = s('client_preparing', _('Preparing client'))
+        # Pre-seeding done, waiting for the repository
+        client_staged = s('client_staged', _('Waiting for repository'))
+        # Crypto is synthesized, server cache synchronized and the cache delta uploaded to client
+        client_syncing = s('client_syncing', _('Synchronizing client'))
         # Cache upload done, borg-create will be started
         client_prepared = s('client_prepared', _('Prepared client'))
         # borg-create has connected to reverse proxy
@@ -352,6 +486,9 @@ class BackupJob(Job):
         # Cache is removed from client
         client_cleanup = s('client_cleanup', _('Client is cleaned up'))
 
+        PREPARATION = frozenset({client_preparing, client_staged})
+        STAGED = frozenset({client_staged})
+
     def __init__(self, repository, client, config):
         super().__init__(repository)
         self.client = client
@@ -359,6 +496,24 @@ class BackupJob(Job):
         self.archive = None
         self.config = config
         self.checkpoint_archives = PersistentList()
+        if config.priority is not None:
+            self.priority = config.priority
+        self.window = config.window
+        self._update_config_index()
+
+    # Number of recent successful jobs of the same config considered by expected_duration, and how far back to look.
+    duration_history = 5
+    duration_history_scan = 50
+
+    def expected_duration(self):
+        durations = []
+        for job in itertools.islice(NumberTree.reversed(self.client.jobs), self.duration_history_scan):
+            if job is not self and getattr(job, 'config', None) == self.config and job.done:
+                durations.append(job.duration)
+                if len(durations) == self.duration_history:
+                    break
+        if durations:
+            return sum(durations, datetime.timedelta()) / len(durations)
 
     @property
     def reverse_path(self):
@@ -378,12 +533,238 @@ class BackupJob(Job):
         return '%s-%s-%s-%05d' % (timestamp, self.short_name, self.client.hostname, self.id)
 
 
+class CacheStagingJobExecutor(BackupJobExecutor):
+    name = 'cache-staging-job'
+    # Staging is opportunistic; if the client is unreachable the staging job just fails.
+    client_probe = False
+
+    @classmethod
+    def conflicts(cls, job, other_job):
+        # The repository is not needed at all, but the cache directory on the client is.
+        return getattr(other_job, 'client', None) == job.client and other_job.state not in other_job.State.STAGED
+
+    @classmethod
+    def prefork(cls, job):
+        job.update_state(CacheStagingJob.State.job_created, CacheStagingJob.State.staging)
+
+    def execute(self):
+        try:
+            with self.master_connection():
+                self.stage_cache(bwlimit=settings.CACHE_STAGING_BWLIMIT)
+            self.job.update_state(CacheStagingJob.State.staging, CacheStagingJob.State.done)
+            log.info('Job %s completed successfully', self.job.id)
+        except CalledProcessError as cpe:
+            self.job.force_state(CacheStagingJob.State.failed)
+            if not self.analyse_job_process_error(cpe):
+                raise
+
+
+class CacheStagingJob(Job):
+    """
+    Push the chunks cache of a repository to a client ahead of a scheduled backup, so that
+    the backup job only has to transfer a delta.
+    """
+    short_name = 'cache-staging'
+    verbose_name = _('Stage cache')
+    executor = CacheStagingJobExecutor
+    # Only an optimization for the backups to come
+    priority = -10
+
+    class State(Job.State):
+        staging = s('staging', _('Staging cache on client'))
+
+        PREPARATION = frozenset({staging})
+
+    def __init__(self, repository, client):
+        super().__init__(repository)
+        self.client = client
+        client.jobs[self.id] = self
+
+    def _log_file_name(self, timestamp):
+        return '%s-%s-%s-%05d' % (timestamp, self.short_name, self.client.hostname, self.id)
+
+
+def stage_client_cache(client, repository):
+    """Create a `CacheStagingJob` for *client* and *repository*, unless the cache is staged already."""
+    version = cache_version(Path(get_cache_dir()) / repository.repository_id)
+    if not version or client.staged_caches.get(repository.repository_id) == version:
+        return
+    for state in (Job.State.job_created, CacheStagingJob.State.staging):
+        for job in data_root().jobs_by_state[state].values():
+            if isinstance(job, CacheStagingJob) and job.client == client and job.repository == repository:
+                return
+    job = CacheStagingJob(repository, client)
+    transaction.get().note('Created cache staging job for client %s, repository %s' % (client.hostname, repository.name))
+    log.info('Created job %s to stage cache of repository %s on client %s', job.id, repository.name, client.hostname)
+
+
+def probe_command_line(connection):
+    command_line = connection.rsh_command()
+    if connection.is_openssh:
+        command_line += '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=%d' % settings.CLIENT_PROBE_TIMEOUT
+    command_line += connection.remote, connection.remote_borg, '--version'
+    return command_line
+
+
+def probe_client(command_line):
+    """
+    Run the probe *command_line*. Return a tuple (borg_version, failure_cause, failure_kwargs);
+    either *borg_version* or *failure_cause* is None.
+    """
+    try:
+        output = subprocess.check_output(command_line, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                                         universal_newlines=True, timeout=settings.CLIENT_PROBE_TIMEOUT * 2)
+    except subprocess.TimeoutExpired:
+        return None, 'client-connection-failed', {'command': command_line, 'exit_code': None}
+    except CalledProcessError as cpe:
+        if cpe_means_connection_failure(cpe):
+            return None, 'client-connection-failed', {'command': command_line, 'exit_code': cpe.returncode}
+        return None, 'client-borg-missing', {'output': cpe.output}
+    # "borg 1.1.0"
+    words = output.split()
+    if not words:
+        return None, 'client-borg-missing', {'output': output}
+    return words[-1], None, None
+
+
+class ClientProbeService(Service):
+    """
+    Probe the clients of queued backup jobs concurrently, before the jobs are dispatched.
+
+    Each client is probed by running ``borg --version`` on it. Jobs of unreachable clients are
+    failed, so that they don't hold up the repository, while the other jobs record the client's
+    Borg version (*client_borg_version*) and may run.
+    """
+
+    def __init__(self, fork, jobs):
+        super().__init__(fork)
+        self.job_ids = [job.id for job in jobs]
+
+    def launch(self):
+        pid = self.fork()
+        if pid:
+            return pid
+        log_to_daemon()
+        set_process_name('borgcubed [client probe]')
+        reset_db_connection()
+        jobs_by_client = collections.defaultdict(list)
+        for id in self.job_ids:
+            job = data_root().jobs[id]
+            jobs_by_client[job.client.hostname].append(job)
+        command_lines = [probe_command_line(jobs[0].client.connection) for jobs in jobs_by_client.values()]
+        log.debug('Probing %d clients', len(command_lines))
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = executor.map(probe_client, command_lines)
+        for jobs, (borg_version, failure_cause, failure_kwargs) in zip(jobs_by_client.values(), results):
+            for job in jobs:
+                if job.state != BackupJob.State.job_created:
+                    continue
+                if failure_cause:
+                    log.error('Job %s failed: client %s did not pass the probe (%s)', job.id, job.client.hostname, failure_cause)
+                    job.set_failure_cause(failure_cause, **failure_kwargs)
+                else:
+                    job.client_borg_version = borg_version
+            transaction.get().note('Recorded probe of client %s' % jobs[0].client.hostname)
+            transaction.commit()
+        sys.exit(0)
+
+
+_probe_service = None
+# Client hostname -> (number of probes, monotonic time before which it isn't probed again)
+_probe_backoff = {}
+# Seconds before a client is probed again, if its jobs still wait for the probe (doubled for every further probe)
+PROBE_BACKOFF = 30
+PROBE_BACKOFF_MAX = 3600
+
+
+def probe_queued_clients(apiserver):
+    global _probe_service
+    if not settings.CLIENT_PROBE_TIMEOUT:
+        return
+    this_very_moment = now()
+    waiting = [job for executor_class, job in apiserver.queue
+               if isinstance(job, BackupJob) and job.state == BackupJob.State.job_created and not job.client_borg_version
+               and not (job.not_before and job.not_before > this_very_moment)]
+    for job in waiting:
+        # The result of the probe becomes visible some time after the probe service exited.
+        apiserver.queue.touch(job)
+    hostnames = {job.client.hostname for job in waiting}
+    for hostname in set(_probe_backoff) - hostnames:
+        del _probe_backoff[hostname]
+    if _probe_service in apiserver.services.values():
+        return
+    # A client whose jobs still wait after a probe (the probe crashed, or its result isn't visible yet)
+    # is probed again later, with exponential back-off.
+    current_time = time.monotonic()
+    jobs = [job for job in waiting if _probe_backoff.get(job.client.hostname, (0, 0))[1] <= current_time]
+    if not jobs:
+        return
+    for hostname in {job.client.hostname for job in jobs}:
+        probes = _probe_backoff.get(hostname, (0, 0))[0]
+        if probes:
+            log.warning('Probing client %s again (probe %d)', hostname, probes + 1)
+        _probe_backoff[hostname] = probes + 1, current_time + min(PROBE_BACKOFF * 2 ** probes, PROBE_BACKOFF_MAX)
+    _probe_service = apiserver.launch_service(ClientProbeService, jobs)
+
+
+_next_staging_sweep = 0
+
+
+def borgcubed_idle(apiserver):
+    probe_queued_clients(apiserver)
+    stage_scheduled_caches(apiserver)
+
+
+def stage_scheduled_caches(apiserver):
+    """Stage caches on clients whose backups are scheduled within CACHE_STAGING_AHEAD."""
+    global _next_staging_sweep
+    if not settings.CACHE_STAGING_AHEAD:
+        return
+    if time.monotonic() < _next_staging_sweep:
+        apiserver.wakeup_in(_next_staging_sweep - time.monotonic())
+        return
+    _next_staging_sweep = time.monotonic() + 60
+    apiserver.wakeup_in(60)
+    this_very_moment = now()
+    for schedule in data_root().schedules:
+        if not schedule.recurrence_enabled:
+            continue
+        occurence = schedule.after(this_very_moment)
+        if not occurence or occurence - this_very_moment > settings.CACHE_STAGING_AHEAD:
+            continue
+        for action in schedule.actions:
+            if not isinstance(action, (ScheduledBackup, RegexBackupMixin)):
+                continue
+            for job_config in action.job_configs():
+                stage_client_cache(job_config.client, job_config.repository)
+    transaction.commit()
+
+
 class BackupConfig(Evolvable):
+    # Retry policy for jobs failing for a likely transient reason (see RETRY_FAILURE_CAUSES):
+    # Maximum number of retries
+    retry_attempts = 0
+    # Seconds before the first retry, doubled for every further retry
+    retry_delay = 300
+    # Retries don't start later than this many seconds after the first attempt (nor after the next scheduled run)
+    retry_window = 6 * 3600
+
+    # Priority of the jobs created from this config; None for the default of backup jobs.
+    priority = None
+
+    # Jobs of this config only start within this time window (datetime.time), if set; see Job.window.
+    window_start = None
+    window_end = None
+
     def __init__(self, client, label, repository):
         self.client = client
         self.label = label
         self.repository = repository
 
+    @property
+    def window(self):
+        return time_window(self.window_start, self.window_end)
+
     def create_job(self):
         job = BackupJob(
             repository=self.repository,
@@ -392,6 +773,50 @@ class BackupConfig(Evolvable):
         )
         transaction.get().note('Created backup job from check config %s on client %s' % (self.oid, self.client.hostname))
         log.info('Created job for client %s, job config %s', self.client.hostname, self.oid)
+        return job
+
+    def next_scheduled_run(self, after):
+        """Return the next time after *after* (datetime) a schedule runs this config, or None."""
+        next_run = None
+        for schedule in data_root().schedules:
+            if not schedule.recurrence_enabled:
+                continue
+            if not any(self in action.job_configs() for action in schedule.actions
+                       if isinstance(action, (ScheduledBackup, RegexBackupMixin))):
+                continue
+            occurence = schedule.after(after)
+            if occurence and (not next_run or occurence < next_run):
+                next_run = occurence
+        return next_run
+
+    def retry(self, job):
+        """
+        Create a job retrying the failed *job*, if the retry policy allows it. Return the new job or None.
+        """
+        if job.attempt > self.retry_attempts:
+            log.info('Not retrying job %s: attempt %d of %d', job.id, job.attempt, self.retry_attempts + 1)
+            return
+        first_attempt = job
+        while first_attempt.retry_of:
+            first_attempt = first_attempt.retry_of
+        not_before = now() + datetime.timedelta(seconds=self.retry_delay * 2 ** (job.attempt - 1))
+        deadline = first_attempt.created + datetime.timedelta(seconds=self.retry_window)
+        next_run = self.next_scheduled_run(now())
+        if next_run:
+            deadline = min(deadline, next_run)
+        if not_before >= deadline:
+            log.info('Not retrying job %s: retry at %s would be past %s', job.id, not_before, deadline)
+            return
+        retry_job = self.create_job()
+        retry_job.retry_of = job
+        retry_job.attempt = job.attempt + 1
+        retry_job.not_before = not_before
+        # Including a window the job got from its schedule
+        retry_job.window = job.window
+        job.retried_by = retry_job
+        transaction.get().note('Job %s retries job %s' % (retry_job.id, job.id))
+        log.info('Job %s will retry job %s (attempt %d) at %s', retry_job.id, job.id, retry_job.attempt, not_before)
+        return retry_job
 
     def __str__(self):
         return _('{client}: {label}').format(
@@ -416,8 +841,13 @@ class ScheduledBackup(ScheduledAction):
     def __str__(self):
         return _('Run {}').format(self.job_config)
 
+    def job_configs(self):
+        return self.job_config,
+
     def execute(self, apiserver):
-        queue_backup_job_conditional(apiserver, self.job_config)
+        job = queue_backup_job_conditional(apiserver, self.job_config)
+        if job and not job.window:
+            job.window = self.schedule.window
         transaction.commit()
 
     class Form(forms.Form):
@@ -440,15 +870,29 @@ class ScheduledBackup(ScheduledAction):
             return data
 
 
-class RegexScheduledBackup(ScheduledAction):
-    name = _('Run bulk backup')
+def stagger_offset(hostname, spread):
+    """
+    Return the start offset (timedelta) of jobs of the client *hostname* within a *spread* (timedelta) window.
 
-    def __init__(self, schedule, client_re, job_config_re):
-        super().__init__(schedule)
-        self.client_re = client_re
-        self.job_config_re = job_config_re
+    The offset is derived from the hostname, so every client starts at the same point in the window each time.
+    """
+    seconds = int(spread.total_seconds())
+    if seconds <= 0:
+        return datetime.timedelta()
+    digest = sha224(hostname.encode()).digest()
+    return datetime.timedelta(seconds=int.from_bytes(digest[:8], 'big') % seconds)
 
-    def execute(self, apiserver):
+
+class RegexBackupMixin:
+    """
+    Create backup jobs for the job configs whose client hostname and label match
+    the regexes *client_re* and *job_config_re*.
+    """
+
+    # Spread the start of the jobs over this many minutes (see stagger_offset), instead of starting all at once.
+    spread = 0
+
+    def job_configs(self):
         client_re = re.compile(self.client_re, re.IGNORECASE)
         job_config_re = re.compile(self.job_config_re, re.IGNORECASE)
 
@@ -460,8 +904,22 @@ class RegexScheduledBackup(ScheduledAction):
                 if not job_config_re.fullmatch(job_config.label):
                     continue
                 log.debug('Matched job config %s to pattern %r', job_config.label, self.job_config_re)
-                job_config.create_job()
-        transaction.commit()
+                yield job_config
+
+    def create_jobs(self):
+        """Create and return the backup jobs."""
+        spread = datetime.timedelta(minutes=self.spread)
+        this_very_moment = now()
+        jobs = []
+        for job_config in self.job_configs():
+            job = job_config.create_job()
+            if not job.window:
+                job.window = self.schedule.window
+            if spread:
+                job.not_before = this_very_moment + stagger_offset(job_config.client.hostname, spread)
+                log.debug('Job %s of client %s starts at %s', job.id, job_config.client.hostname, job.not_before)
+            jobs.append(job)
+        return jobs
 
     class Form(forms.Form):
         client_re = forms.CharField(
@@ -474,3 +932,99 @@ class RegexScheduledBackup(ScheduledAction):
             initial='.*',
             label=_('Regex for selecting configurations'),
         )
+        spread = forms.IntegerField(
+            min_value=0,
+            initial=0,
+            required=False,
+            label=_('Spread start over (minutes)'),
+            help_text=_('Jobs start at a fixed offset per client within this window, '
+                        'instead of all at once.'),
+        )
+
+
+class RegexScheduledBackup(RegexBackupMixin, ScheduledAction):
+    name = _('Run bulk backup')
+
+    def __init__(self, schedule, client_re, job_config_re, spread=0):
+        super().__init__(schedule)
+        self.client_re = client_re
+        self.job_config_re = job_config_re
+        self.spread = spread or 0
+
+    def execute(self, apiserver):
+        self.create_jobs()
+        transaction.commit()
+
+
+def prune_configs_as_choices():
+    yield '', _('None')
+    for config in prune_root().configs:
+        yield config.oid, config
+
+
+def check_configs_as_choices():
+    yield '', _('None')
+    for repository in data_root().repositories:
+        for config in repository.job_configs:
+            yield config.oid, '%s: %s' % (repository.name, config.label)
+
+
+class ChainedBackup(RegexBackupMixin, ScheduledAction):
+    """
+    Run bulk backups, followed by a prune job once all backups finished, followed by a check job.
+
+    The follow-up jobs are created right away, but only start when their predecessors finished (Job.predecessors).
+    """
+    name = _('Run bulk backup, then prune and check')
+
+    def __init__(self, schedule, client_re, job_config_re, spread=0, prune_config=None, check_config=None):
+        super().__init__(schedule)
+        self.client_re = client_re
+        self.job_config_re = job_config_re
+        self.spread = spread or 0
+        self.prune_config = prune_config
+        self.check_config = check_config
+
+    def execute(self, apiserver):
+        jobs = self.create_jobs()
+        if self.prune_config:
+            prune_job = self.prune_config.create_job()
+            prune_job.predecessors = PersistentList(jobs)
+            log.debug('Prune job %s follows %d backup jobs', prune_job.id, len(jobs))
+            jobs = [prune_job]
+        if self.check_config:
+            repository = self.check_config.repository
+            check_job = self.check_config.create_job()
+            # A prune job may touch any repository, backup jobs only precede the check of their repository.
+            check_job.predecessors = PersistentList(job for job in jobs
+                                                    if job.short_name == 'prune' or job.repository == repository)
+            log.debug('Check job %s follows jobs %s', check_job.id, ', '.join(str(job.id) for job in jobs))
+        transaction.commit()
+
+    class Form(RegexBackupMixin.Form):
+        prune_config = forms.ChoiceField(choices=prune_configs_as_choices, required=False,
+                                         label=_('Then prune'))
+        check_config = forms.ChoiceField(choices=check_configs_as_choices, required=False,
+                                         label=_('Then check'))
+
+        def __init__(self, *args, **kwargs):
+            try:
+                kwargs['initial'] = initial = dict(kwargs['initial'])
+                for field in ('prune_config', 'check_config'):
+                    if initial.get(field):
+                        initial[field] = initial[field].oid
+            except KeyError:
+                pass
+            super().__init__(*args, **kwargs)
+
+        def clean(self):
+            data = super().clean()
+            for field, cls in (('prune_config', PruneConfig), ('check_config', CheckConfig)):
+                if not data.get(field):
+                    data[field] = None
+                    continue
+                o = data_root()._p_jar[oid_bytes(data[field])]
+                if not isinstance(o, cls):
+                    raise ValidationError('Invalid object reference')
+                data[field] = o
+            return data
@@ -119,6 +119,8 @@ class CheckJob(Job):
     short_name = 'check'
     verbose_name = _('Check data')
     executor = CheckJobExecutor
+    # Checks take long and are usually not urgent; don't let them delay backups.
+    priority = -5
 
     class State(Job.State):
         repository_check = s('repository_check', _('Checking repository'))
@@ -128,3 +130,4 @@ class CheckJob(Job):
     def __init__(self, config: CheckConfig):
         super().__init__(config.repository)
         self.config = config
+        self._update_config_index()
@@ -198,6 +198,7 @@ class PruneConfig(Evolvable):
         job = PruneJob(config=self)
         transaction.get().note('Created prune job from config %s' % self.oid)
         log.info('Created prune job for config %s', self.oid)
+        return job
 
     class Form(forms.Form):
         name = forms.CharField()
@@ -232,6 +233,7 @@ class PruneJob(Job):
     def __init__(self, config: PruneConfig):
         super().__init__()
         self.config = config
+        self._update_config_index()
         self.repositories = PersistentList()
 
     def find_archives(self):
@@ -252,6 +254,6 @@ class PruneJob(Job):
 
 def borgcube_job_blocked(job, blocking_jobs):
     for state in (PruneJob.State.discovering, PruneJob.State.prune):
-        for other in data_root().jobs_by_state[state]:
+        for other in data_root().jobs_by_state.get(state, {}).values():
             if other.short_name == 'prune' and job.repository in other.repositories:
                 blocking_jobs.append(other)
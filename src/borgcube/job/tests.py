@@ -0,0 +1,161 @@
+import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import transaction
+
+from borgcube.core.models import Client, Repository, RshClientConnection, TimeWindow
+from borgcube.utils import data_root
+from .backup import BackupConfig, BackupJob, BackupJobExecutor, probe_client, stagger_offset
+
+
+@pytest.fixture
+def config():
+    with transaction.manager:
+        repository = Repository('testrepo', '/srv/testrepo', repository_id='1234')
+        data_root().repositories.append(repository)
+        client = data_root().clients['testhost'] = Client('testhost', connection=RshClientConnection('root@testhost'))
+        config = BackupConfig(client, 'home', repository)
+        client.job_configs.append(config)
+    return config
+
+
+def test_transfer_cache_keeps_staged_chunks(tmpdir):
+    executor = BackupJobExecutor.__new__(BackupJobExecutor)
+    executor.client = SimpleNamespace(connection=SimpleNamespace(remote='root@testhost'))
+    executor.remote_repository_cache_dir = '.cache/borg/1234/'
+    executor.cache_path = Path(str(tmpdir.mkdir('cache')))
+    rsyncs = []
+    executor.rsync_call = lambda *args: rsyncs.append(args)
+    executor.rsh_call = lambda *command: None
+    executor.set_staged_cache_version = lambda version: None
+
+    job_cache_path = Path(str(tmpdir.mkdir('job')))
+    executor.transfer_cache(job_cache_path)
+    assert not job_cache_path.exists()
+
+    auxiliary, chunks = rsyncs
+    # --delete on the auxiliary files must not remove the chunks cache staged on the client,
+    # which is sent as a delta afterwards.
+    assert '--delete' in auxiliary
+    assert ('--exclude', '/chunks') in zip(auxiliary, auxiliary[1:])
+    assert auxiliary[-2:] == (str(job_cache_path) + '/', 'root@testhost:.cache/borg/1234/')
+    assert chunks[-2:] == (str(executor.cache_path / 'chunks'), 'root@testhost:.cache/borg/1234/')
+
+
+def backup_job(state, client):
+    return SimpleNamespace(state=state, State=BackupJob.State, client=client)
+
+
+def test_backup_job_conflicts():
+    State = BackupJob.State
+    conflicts = BackupJobExecutor.conflicts
+    # Jobs of the same repository
+
+    # A new job is prepared while another job uses the repository, but only one job is prepared at a time.
+    new_job = backup_job(State.job_created, 'client1')
+    assert not conflicts(new_job, backup_job(State.client_in_progress, 'client2'))
+    assert not conflicts(new_job, backup_job(State.client_syncing, 'client2'))
+    assert conflicts(new_job, backup_job(State.client_preparing, 'client2'))
+    assert conflicts(new_job, backup_job(State.client_staged, 'client2'))
+    # The cache directory on the client is used by the other job
+    assert conflicts(new_job, backup_job(State.client_in_progress, 'client1'))
+
+    # A staged job waits for the repository, but not for the preparation of other jobs.
+    staged_job = backup_job(State.client_staged, 'client1')
+    assert conflicts(staged_job, backup_job(State.client_in_progress, 'client2'))
+    assert conflicts(staged_job, backup_job(State.client_syncing, 'client2'))
+    assert not conflicts(staged_job, backup_job(State.client_preparing, 'client2'))
+    assert not conflicts(staged_job, backup_job(State.client_staged, 'client2'))
+    assert conflicts(staged_job, backup_job(State.client_preparing, 'client1'))
+
+
+def test_probe_client_output(monkeypatch):
+    monkeypatch.setattr('subprocess.check_output', lambda *args, **kwargs: 'borg 1.1.0\n')
+    assert probe_client(['borg', '--version']) == ('1.1.0', None, None)
+    monkeypatch.setattr('subprocess.check_output', lambda *args, **kwargs: '')
+    borg_version, failure_cause, failure_kwargs = probe_client(['borg', '--version'])
+    assert borg_version is None
+    assert failure_cause == 'client-borg-missing'
+
+
+def test_retry_keeps_window(config):
+    config.retry_attempts = 1
+    with transaction.manager:
+        job = config.create_job()
+        # Eg. the window of the schedule which created the job
+        job.window = TimeWindow(datetime.time(22), datetime.time(6))
+    retry_job = config.retry(job)
+    assert retry_job.window is job.window
+
+
+@pytest.fixture
+def frozen_now(monkeypatch):
+    current = datetime.datetime(2026, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    monkeypatch.setattr('borgcube.job.backup.now', lambda: current)
+    return current
+
+
+def failed_job(config, created):
+    with transaction.manager:
+        job = config.create_job()
+        job.created = created
+    return job
+
+
+def test_retry_backoff(config, frozen_now):
+    config.retry_attempts = 2
+    config.retry_delay = 300
+    job = failed_job(config, frozen_now)
+    first_retry = config.retry(job)
+    assert first_retry.attempt == 2
+    assert first_retry.retry_of is job and job.retried_by is first_retry
+    assert first_retry.not_before == frozen_now + datetime.timedelta(seconds=300)
+    second_retry = config.retry(first_retry)
+    assert second_retry.attempt == 3
+    assert second_retry.not_before == frozen_now + datetime.timedelta(seconds=600)
+    # Out of attempts
+    assert config.retry(second_retry) is None
+
+
+def test_retry_disabled(config, frozen_now):
+    assert config.retry(failed_job(config, frozen_now)) is None
+
+
+def test_retry_deadline(config, frozen_now, monkeypatch):
+    config.retry_attempts = 5
+    config.retry_delay = 600
+    config.retry_window = 3600
+    monkeypatch.setattr(BackupConfig, 'next_scheduled_run', lambda self, after: None)
+    assert config.retry(failed_job(config, frozen_now))
+    # The retry window counts from the first attempt
+    assert config.retry(failed_job(config, frozen_now - datetime.timedelta(minutes=50))) is None
+    job = failed_job(config, frozen_now - datetime.timedelta(minutes=40))
+    retry_job = config.retry(job)
+    assert retry_job
+    with transaction.manager:
+        retry_job.created = frozen_now
+    # The second retry would be 20 minutes after, ie. past the window of the first attempt.
+    assert config.retry(retry_job) is None
+
+    # Nor later than the next scheduled run of the config
+    monkeypatch.setattr(BackupConfig, 'next_scheduled_run',
+                        lambda self, after: after + datetime.timedelta(minutes=5))
+    assert config.retry(failed_job(config, frozen_now)) is None
+    monkeypatch.setattr(BackupConfig, 'next_scheduled_run',
+                        lambda self, after: after + datetime.timedelta(minutes=15))
+    assert config.retry(failed_job(config, frozen_now))
+
+
+def test_stagger_offset():
+    spread = datetime.timedelta(minutes=30)
+    offsets = {hostname: stagger_offset(hostname, spread) for hostname in ('host%d' % i for i in range(100))}
+    for hostname, offset in offsets.items():
+        assert stagger_offset(hostname, spread) == offset
+        assert datetime.timedelta() <= offset < spread
+    # Spread over the window, not all at the same moment
+    assert len(set(offsets.values())) > 50
+    assert stagger_offset('host0', datetime.timedelta()) == datetime.timedelta()
+    assert stagger_offset('host0', datetime.timedelta(seconds=1)) == datetime.timedelta()
@@ -1,6 +1,8 @@
 import functools
 import logging
 import re
+import resource
+import time
 from binascii import unhexlify
 
 import msgpack
@@ -14,7 +16,8 @@ from borg.remote import RepositoryServer, PathNotAllowed
 from borg.cache import Cache
 from borg.item import ArchiveItem
 
-from ..core.models import Archive
+from ..core.models import Archive, rusage_dict, RESOURCE_USAGE_ATTEMPTS
+from ..daemon.utils import heartbeat
 from ..job.backup import BackupJob
 from ..keymgt import synthetic_key_from_data, synthesize_client_key, SyntheticManifest
 from ..utils import set_process_name, open_repository, data_root
@@ -41,6 +44,17 @@ def doom_on_exception(exc_whitelist=(Repository.ObjectNotFound, IntegrityError))
     return decorator
 
 
+def beats(proxy_method):
+    """Record a heartbeat of the job (see STALL_TIMEOUTS) when *proxy_method* is called by the client."""
+    @functools.wraps(proxy_method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return proxy_method(self, *args, **kwargs)
+        finally:
+            self._heartbeat()
+    return wrapper
+
+
 class ReverseRepositoryProxy(RepositoryServer):
     rpc_methods = (
         '__len__',
@@ -63,6 +77,9 @@ class ReverseRepositoryProxy(RepositoryServer):
     )
 
     _cache = None
+    # Record at most one heartbeat per this many seconds.
+    heartbeat_interval = 1
+    _last_heartbeat = 0
 
     def __init__(self, restrict_to_paths=(), append_only=False):
         super().__init__(restrict_to_paths, append_only)
@@ -73,7 +90,29 @@ class ReverseRepositoryProxy(RepositoryServer):
         finally:
             if self._cache:
                 self._cache.close()
+            if getattr(self, 'job', None):
+                self._account_resource_usage()
 
+    def _account_resource_usage(self):
+        usage = rusage_dict(resource.getrusage(resource.RUSAGE_SELF))
+        children_usage = rusage_dict(resource.getrusage(resource.RUSAGE_CHILDREN))
+        try:
+            # The totals of the repository and client are shared with other jobs (and the daemon).
+            for attempt in transaction.manager.attempts(RESOURCE_USAGE_ATTEMPTS):
+                with attempt as txn:
+                    self.job.account_resource_usage('proxy', usage)
+                    self.job.account_resource_usage('proxy', children_usage)
+                    txn.note('Accounted resource usage of proxy of job %s' % self.job.id)
+        except Exception:
+            log.exception('Could not store resource usage of job %s', self.job.id)
+
+    def _heartbeat(self):
+        if not getattr(self, 'job', None) or time.monotonic() - self._last_heartbeat < self.heartbeat_interval:
+            return
+        self._last_heartbeat = time.monotonic()
+        heartbeat(self.job.id)
+
+    @beats
     @doom_on_exception()
     def open(self, path, create=False, lock_wait=None, lock=True, exclusive=None, append_only=False):
         if create:
@@ -168,6 +207,7 @@ class ReverseRepositoryProxy(RepositoryServer):
             client_data = self._client_key.encrypt(client_plaintext_chunk)
         return client_data
 
+    @beats
     @doom_on_exception()
     def get(self, id):
         """API"""
@@ -175,12 +215,14 @@ class ReverseRepositoryProxy(RepositoryServer):
         client_data = self._repo_to_client(id, repo_data)
         return client_data
 
+    @beats
     @doom_on_exception()
     def get_many(self, ids, is_preloaded=False):
         """API"""
         for id, repo_data in zip(ids, self.repository.get_many(ids, is_preloaded)):
             yield self._repo_to_client(id, repo_data)
 
+    @beats
     @doom_on_exception()
     def put(self, id, data, wait=True):
         """API"""
@@ -204,6 +246,7 @@ class ReverseRepositoryProxy(RepositoryServer):
             repo_data = self._repository_key.encrypt(repo_plaintext_chunk)
             self.repository.put(id, repo_data, wait)
 
+    @beats
     @doom_on_exception()
     def delete(self, id, wait=True):
         """API"""
@@ -214,6 +257,7 @@ class ReverseRepositoryProxy(RepositoryServer):
         assert not self._cache.seen_chunk(id)
         del self._cache.chunks[id]
 
+    @beats
     @doom_on_exception()
     def rollback(self):
         """API"""
@@ -247,6 +291,7 @@ class ReverseRepositoryProxy(RepositoryServer):
         transaction.commit()
         log.debug('Saved archive metadata')
 
+    @beats
     @doom_on_exception()
     def commit(self, save_space=False):
         """API"""
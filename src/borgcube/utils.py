@@ -160,18 +160,25 @@ except ImportError:
 
 
 class DaemonLogHandler(logging.Handler):
+    """
+    Ship log records to the log sink of borgcubed.
+
+    Records are pushed without waiting for the daemon. Up to *buffer* records are queued locally
+    if the daemon doesn't keep up (or isn't there); further records are dropped (and counted in *dropped*).
+    """
     socket = None
 
-    def __init__(self, addr_or_socket, level=logging.NOTSET, context=None):
+    def __init__(self, addr_or_socket, level=logging.NOTSET, context=None, buffer=10000):
         super().__init__(level)
         if isinstance(addr_or_socket, str):
-            self.socket = (context or zmq.Context.instance()).socket(zmq.REQ)
+            self.socket = (context or zmq.Context.instance()).socket(zmq.PUSH)
+            self.socket.sndhwm = buffer
             self.socket.connect(addr_or_socket)
         else:
             self.socket = addr_or_socket
+        # Time to deliver queued records when closing.
         self.socket.linger = 2000
-        self.socket.rcvtimeo = 2000
-        self.socket.sndtimeo = 2000
+        self.dropped = 0
 
     def emit(self, record):
         (self.formatter or logging._defaultFormatter).usesTime = lambda: True
@@ -191,13 +198,22 @@ class DaemonLogHandler(logging.Handler):
             'asctime': record.asctime,
             'pid': record.process,
         }
-        self.socket.send_json(request)
-        reply = self.socket.recv_json()
-        if not reply['success']:
-            raise RuntimeError('Error sending log message to borgcubed: %s' % reply['message'])
+        try:
+            self.socket.send_json(request, zmq.NOBLOCK)
+        except zmq.Again:
+            self.dropped += 1
+
+    def close(self):
+        if self.socket and not self.socket.closed:
+            self.socket.close()
+        super().close()
 
 
 class log_to_daemon:
+    def __init__(self, address=None):
+        # Address of the log sink of borgcubed, by default the local one.
+        self.address = address
+
     def __enter__(self):
         from .daemon.utils import get_socket_addr
         logging_config = settings.LOGGING
@@ -207,7 +223,7 @@ class log_to_daemon:
                     'level': 'DEBUG',
                     'class': 'borgcube.utils.DaemonLogHandler',
                     'formatter': 'standard',
-                    'addr_or_socket': 'ipc://' + get_socket_addr('daemon'),
+                    'addr_or_socket': self.address or 'ipc://' + get_socket_addr('daemon-log'),
                 },
             },
             'formatters': {
@@ -220,7 +236,7 @@ class log_to_daemon:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         handler = logging.getLogger('').handlers[-1]
-        handler.socket.close()
+        handler.close()
 
     __call__ = __enter__
 
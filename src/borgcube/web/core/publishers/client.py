@@ -5,7 +5,7 @@ from borgcube.job.backup import BackupConfig
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 
-from borgcube.core.models import Client, RshClientConnection, Repository, NumberTree
+from borgcube.core.models import Client, RshClientConnection, Repository, NumberTree, validate_time_window
 from borgcube.utils import data_root, find_oid, paginate
 from . import Publisher
 
@@ -123,6 +123,30 @@ class JobConfigForm(forms.Form):
                                         help_text=_('These options are passed verbatim to Borg on the client. Please '
                                                     'don\'t specify any logging options or --remote-path.'))
 
+        retry_attempts = forms.IntegerField(min_value=0, initial=0,
+                                            help_text=_('How often a job that failed for a likely transient reason '
+                                                        '(eg. the client was not reachable) is retried.'))
+        retry_delay = forms.IntegerField(min_value=0, initial=300,
+                                         help_text=_('Seconds before the first retry. Doubled for every further retry.'))
+        retry_window = forms.IntegerField(min_value=0, initial=6 * 3600,
+                                          help_text=_('Retries are not started later than this many seconds after the '
+                                                      'first attempt, nor after the next scheduled run.'))
+
+        priority = forms.IntegerField(required=False,
+                                      help_text=_('Jobs with a higher priority are started first. Leave empty for '
+                                                  'the default priority of backups (10).'))
+
+        window_start = forms.TimeField(required=False, label=_('Start jobs from'))
+        window_end = forms.TimeField(required=False, label=_('Start jobs until'),
+                                     help_text=_('Jobs are only started in this time window (eg. 22:00 to 06:00), '
+                                                 'if they are expected to finish before it closes. This takes '
+                                                 'precedence over the time window of a schedule.'))
+
+        def clean(self):
+            cleaned_data = super().clean()
+            validate_time_window(cleaned_data)
+            return cleaned_data
+
 
 class JobConfigsPublisher(Publisher):
     companion = 'configs'
@@ -105,8 +105,14 @@ def job_outcome(job):
                 return _('Locking error')
             elif failure_kind == 'client-borg-outdated':
                 return _('Borg on the client is outdated')
+            elif failure_kind == 'client-borg-missing':
+                return _('Borg not found on the client')
             elif failure_kind == 'borgcubed-restart':
                 return _('borgcubed terminated/restarted')
+            elif failure_kind == 'stalled':
+                return _('Stalled (no progress for %d seconds)') % failure_cause['timeout']
+            elif failure_kind == 'agent-lost':
+                return _('Lost worker agent %s') % failure_cause['agent']
             else:
                 return failure_kind
         else:
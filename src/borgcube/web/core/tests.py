@@ -6,7 +6,10 @@ import pytest
 
 import transaction
 
+import zmq
+
 from borgcube.core.models import Client, RshClientConnection
+from borgcube.daemon.client import APIClient
 from . import views
 
 
@@ -34,6 +37,14 @@ def test_list_clients(rf, client):
     assert list(clients) == [client]
 
 
+def test_metrics_daemon_unavailable(rf, monkeypatch):
+    def metrics(self):
+        raise zmq.Again()
+    monkeypatch.setattr(APIClient, 'metrics', metrics)
+    response = views.metrics(rf.get(''))
+    assert response.status_code == 503
+
+
 def template_response_contents(tr):
     tr.render()
     return bytes(tr).decode()
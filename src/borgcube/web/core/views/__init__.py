@@ -1,8 +1,15 @@
+import logging
 
+import zmq
+
+from borgcube.daemon.client import APIClient, APIError
+from borgcube.daemon.metrics import render_metrics, CONTENT_TYPE
 from borgcube.utils import data_root
 from django.http import Http404
 from django.http import HttpResponse
 
+log = logging.getLogger(__name__)
+
 
 def trigger(request, trigger_id):
     # This is a URL-based view, since it can be called anonymously (I plan to make everything
@@ -15,3 +22,16 @@ def trigger(request, trigger_id):
     # this might become unnecessary. (TODO/SEC)
     trig.run(access_context='anonymous-web')
     return HttpResponse()
+
+
+def metrics(request):
+    # URL-based as well, for scraping by monitoring systems.
+    client = APIClient()
+    try:
+        families = client.metrics()
+    except (zmq.ZMQError, APIError) as exc:
+        log.error('Could not get metrics from borgcubed: %s', exc)
+        return HttpResponse('borgcubed is not available\n', status=503, content_type='text/plain')
+    finally:
+        client.close()
+    return HttpResponse(render_metrics(families), content_type=CONTENT_TYPE)
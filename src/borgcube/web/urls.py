@@ -28,6 +28,7 @@ urlpatterns = [
     url(r'^javascript-i18n/$', i18n.javascript_catalog, js_info_dict),
     url(r'^static/(?P<file>[a-zA-Z0-9\.]+)$', staticfiles.staticfiles),
 
+    url(r'^metrics/$', core_views.metrics),
     url(r'^trigger/(?P<trigger_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})/$', core_views.trigger),
 
     url(r'^$', object_publisher, kwargs={'path': '/'}),